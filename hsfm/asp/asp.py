@@ -4,7 +4,6 @@ import rasterio
 import os
 import psutil
 import shutil
-import utm
 
 import bare
 import hsfm.io
@@ -188,9 +187,7 @@ def dem_mosaic_custom(output_directory,
     
     dems = glob.glob(os.path.join(stereo_output_directory,'*','*-DEM.tif'))
     
-    call = ['dem_mosaic']
-    call.extend(dems)
-    call.extend(['-o', output_file])
+    call = ['dem_mosaic', *dems, '-o', output_file]
 
     if print_asp_call==True:
         print(*call)
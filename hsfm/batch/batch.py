@@ -1,6 +1,5 @@
 from osgeo import gdal
 import os
-import cv2
 import sys
 import glob
 import numpy as np
@@ -8,10 +7,13 @@ import pandas as pd
 from datetime import datetime
 import matplotlib.pyplot as plt
 import concurrent.futures
-import psutil
+import functools
+import multiprocessing
 import pathlib
+import re
 import shutil
 import time
+import traceback
 import geopandas as gpd
 
 import hipp
@@ -23,6 +25,9 @@ Inputs are general a folder contaning multiple files or a csv listing
 multiple urls.
 """
 
+# matches the unscaled pixel pitch line in tsai camera files, with any spacing
+PITCH_RE = re.compile(rb'^pitch[ \t]*=[ \t]*1(?:\.0*)?(?=[ \t]*\r?$)', re.MULTILINE)
+
 def prepare_ba_run(input_directory,
                    output_directory,
                    scale):
@@ -70,37 +75,51 @@ def prepare_stereo_run(output_directory):
 
 
 
+def _rescale_one(image_file,
+                 output_directory,
+                 scale=8):
+
+    # runs in one of cpu_count() worker processes, so each keeps gdal to a single thread
+    gdal.SetConfigOption('GDAL_NUM_THREADS', '1')
+
+    file_path, file_name, file_extension = hsfm.io.split_file(image_file)
+    output_file_name = os.path.join(output_directory, file_name+file_extension)
+
+    percent = 100/scale
+    options = gdal.TranslateOptions(format='GTiff',
+                                    widthPct=percent,
+                                    heightPct=percent,
+                                    resampleAlg='average',
+                                    creationOptions=['TILED=YES',
+                                                     *hsfm.utils.gtiff_compression_options(),
+                                                     'BIGTIFF=IF_SAFER',
+                                                     'NUM_THREADS=1'])
+    ds = gdal.Translate(output_file_name, image_file, options=options)
+    ds = None
+
+    return output_file_name
+
 def rescale_images(image_directory,
                    output_directory,
                    extension='.tif',
                    scale=8,
                    verbose=False):
-    
+
     output_directory = os.path.join(output_directory, 'images'+'_sub'+str(scale))
-    
-    
+
+    # create once here to avoid workers racing on makedirs
+    hsfm.io.create_dir(output_directory)
+
     image_files  = sorted(glob.glob(os.path.join(image_directory,'*'+ extension)))
-    
-#     n = len(psutil.Process().cpu_affinity())
-#     pool = concurrent.futures.ThreadPoolExecutor(max_workers=n)
-    
-#     parallel_data = {pool.submit(hsfm.utils.rescale_geotif,
-#                                  image_file,
-#                                  output_directory=output_directory,
-#                                  scale=scale): \
-#                      image_file for image_file in image_files}
-    
-#     for future in concurrent.futures.as_completed(parallel_data):
-#         r = future.result()
-#         if verbose:
-#             print(r)
 
-    for image_file in image_files:
-        
-        hsfm.utils.rescale_geotif(image_file,
-                                  output_directory=output_directory,
-                                  scale=scale,
-                                  verbose=verbose)
+    worker = functools.partial(_rescale_one,
+                               output_directory=output_directory,
+                               scale=scale)
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+        for output_file_name in executor.map(worker, image_files):
+            if verbose:
+                print(output_file_name)
 
     return os.path.relpath(output_directory)
 #     return sorted(glob.glob(os.path.join(output_directory,'*'+ extension)))
@@ -113,24 +132,45 @@ def rescale_tsai_cameras(camera_directory,
     output_directory = os.path.join(output_directory, 'cameras'+'_sub'+str(scale))
     hsfm.io.create_dir(output_directory)
     
-    pitch = "pitch = 1"
-    new_pitch = "pitch = "+str(scale)
+    new_pitch = ("pitch = "+str(scale)).encode()
     
     camera_files  = sorted(glob.glob(os.path.join(camera_directory,'*'+ extension)))
-                 
-    for camera_file in camera_files:
-        
+    
+    def _rewrite(camera_file):
         file_path, file_name, file_extension = hsfm.io.split_file(camera_file)
         output_file = os.path.join(output_directory, 
                                    file_name +'_sub'+str(scale)+file_extension)
-                                   
-        
-        hsfm.io.replace_string_in_file(camera_file, output_file, pitch, new_pitch)
+        data = pathlib.Path(camera_file).read_bytes()
+        pathlib.Path(output_file).write_bytes(PITCH_RE.sub(new_pitch, data, count=1))
+        return output_file
+    
+    # camera files are tiny, so this is bound by file system latency rather than cpu
+    max_workers = min(32, os.cpu_count()*4)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(_rewrite, camera_files))
         
     return os.path.relpath(output_directory)
 #     return sorted(glob.glob(os.path.join(output_directory,'*'+ extension)))
     
     
+def _check_image_count(image_list, df):
+    if len(image_list) != len(df):
+        raise ValueError('Mismatch between metadata entries in camera position file and available images: '+
+                         str(len(image_list))+' images vs '+str(len(df))+' metadata rows.')
+
+def _image_size(image_file_name):
+    # keyed on mtime as well, so an image rewritten in this process is read again
+    return _cached_image_size(os.path.abspath(image_file_name),
+                              os.path.getmtime(image_file_name))
+
+@functools.lru_cache(maxsize=1024)
+def _cached_image_size(image_file_name, mtime):
+    # OpenEx with explicit flags skips probing for sidecar files
+    ds = gdal.OpenEx(image_file_name, gdal.OF_RASTER | gdal.OF_READONLY)
+    size = (ds.RasterXSize, ds.RasterYSize)
+    ds = None
+    return size
+    
 def batch_generate_cameras(image_directory,
                            camera_positions_file_name,
                            reference_dem_file_name,
@@ -163,22 +203,24 @@ def batch_generate_cameras(image_directory,
     if reverse_order:
         image_list = image_list[::-1]
     
+    # check counts before computing headings so configuration errors fail fast
+    if not isinstance(camera_positions_file_name, type(pd.DataFrame())):
+        df = pd.read_csv(camera_positions_file_name)
+    else:
+        df = camera_positions_file_name
+    df = hsfm.core.subset_images_for_download(df, subset)
+    _check_image_count(image_list, df)
+    
     if manual_heading_selection == False:
-        df = hsfm.batch.calculate_heading_from_metadata(camera_positions_file_name,
+        df = hsfm.batch.calculate_heading_from_metadata(df,
                                                         output_directory=output_directory, 
-                                                        subset=subset,
                                                         reverse_order=reverse_order)
     else:
-        df = hsfm.utils.pick_headings(image_directory, camera_positions_file_name, subset, delta=0.01)
+        df = hsfm.utils.pick_headings(image_list, df, delta=0.01)
     
-    if len(image_list) != len(df):
-        print('Mismatch between metadata entries in camera position file and available images.')
-        sys.exit(1)
-    
-    for i,v in enumerate(image_list):
-        image_file_name = v
-        camera_lat_lon_center_coordinates = (df['Latitude'].iloc[i], df['Longitude'].iloc[i])
-        heading = df['heading'].iloc[i]
+    positions = df[['Latitude', 'Longitude', 'heading']].itertuples(index=False, name=None)
+    for image_file_name, (lat, lon, heading) in zip(image_list, positions):
+        camera_lat_lon_center_coordinates = (lat, lon)
         
         gcp_directory = hsfm.core.prep_and_generate_gcp(image_file_name,
                                                         camera_lat_lon_center_coordinates,
@@ -188,11 +230,9 @@ def batch_generate_cameras(image_directory,
                                                         output_directory)
         
     
-        # principal_point_px is needed to initialize the cameras in the next step.
-        img_ds = gdal.Open(image_file_name)
-        image_width_px = img_ds.RasterXSize
-        image_height_px = img_ds.RasterYSize
-        principal_point_px = (image_width_px / 2, image_height_px /2 )
+    # principal_point_px is needed to initialize the cameras in the next step.
+    image_width_px, image_height_px = _image_size(image_list[-1])
+    principal_point_px = (image_width_px / 2, image_height_px /2 )
     
     focal_length_px = focal_length_mm / pixel_pitch_mm
     
@@ -233,28 +273,22 @@ def calculate_heading_from_metadata(df,
     df = df.sort_values(by=[file_base_name_column])
     if reverse_order:
         df = df.sort_values(by=[file_base_name_column], ascending=False)
-    lons = df[longitude_column].values
-    lats = df[latitude_column].values
-    
-    headings = []
-    for i, v in enumerate(lats):
-        try:
-            p0_lon = lons[i]
-            p0_lat = lats[i]
+    lons = np.asarray(df[longitude_column].values, dtype=float)
+    lats = np.asarray(df[latitude_column].values, dtype=float)
+
+    # vectorized form of hsfm.geospatial.calculate_heading between consecutive images
+    delta_x = np.radians(lons[1:] - lons[:-1])
+    lat1 = np.radians(lats[:-1])
+    lat2 = np.radians(lats[1:])
+    x = np.sin(delta_x) * np.cos(lat2)
+    y = np.cos(lat1) * np.sin(lat2) - np.sin(lat1) * np.cos(lat2) * np.cos(delta_x)
+    headings = (np.degrees(np.arctan2(x, y)) + 360) % 360
+
+    # assume that the final image is oriented
+    # the same as the previous, i.e. the flight
+    # direction did not change
+    headings = np.r_[headings, headings[-1:]]
 
-            p1_lon = lons[i+1]
-            p1_lat = lats[i+1]
-        
-            heading = hsfm.geospatial.calculate_heading(p0_lon,p0_lat,p1_lon,p1_lat)
-            headings.append(heading)
-    
-        except:
-            # When the loop reaches the last element, 
-            # assume that the final image is oriented 
-            # the same as the previous, i.e. the flight 
-            # direction did not change
-            headings.append(heading)
-            
     df = df.sort_values(by=[file_base_name_column], ascending=True)   
     df['heading'] = headings
     
@@ -305,11 +339,23 @@ def calculate_heading_from_metadata(df,
     else:
         return df
 
+def _download_one(pid,
+                  file_name,
+                  output_directory,
+                  image_type = 'pid_tiff',
+                  image_extension = '.tif'):
+    print('Downloading',file_name, image_type)
+    img_gray = hsfm.core.download_image(pid)
+    out = os.path.join(output_directory, file_name+image_extension)
+    hsfm.utils.write_geotif(img_gray, out)
+    return out
+
 def download_images_to_disk(image_metadata, 
                             output_directory = 'output_data/raw_images',
                             image_type = 'pid_tiff',
                             image_file_name_column = 'fileName',
-                            image_extension = '.tif'):
+                            image_extension = '.tif',
+                            max_workers = 16):
                             
     if not isinstance(image_metadata, type(pd.DataFrame())):
         df = pd.read_csv(image_metadata)
@@ -320,14 +366,19 @@ def download_images_to_disk(image_metadata,
     
     
     targets = dict(zip(df[image_type], df[image_file_name_column]))
-    for pid, file_name in targets.items():
-        print('Downloading',file_name, image_type)
-        img_gray = hsfm.core.download_image(pid)
-        out = os.path.join(output_directory, file_name+image_extension)
-        cv2.imwrite(out,img_gray)
-        final_output = hsfm.utils.optimize_geotif(out)
-        os.remove(out)
-        os.rename(final_output, out)
+    
+    # downloads are network bound and the GIL is released during socket reads
+    # and GDAL writes, so threads are sufficient to overlap requests.
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(_download_one,
+                                   pid,
+                                   file_name,
+                                   output_directory,
+                                   image_type = image_type,
+                                   image_extension = image_extension) \
+                   for pid, file_name in targets.items()]
+        for future in concurrent.futures.as_completed(futures):
+            future.result()
     
     return output_directory
         
@@ -684,7 +735,14 @@ def NAGAP_pre_process_set(df,
                     print("Only",str(len(df_tmp)),'images found. Skipping.')
                 
 
-def plot_match_overlap(match_files_directory, images_directory, output_directory='qc/matches/'):
+def plot_match_overlap(match_files_directory, 
+                       images_directory, 
+                       output_directory='qc/matches/',
+                       overview=None):
+    """
+    Specify overview (0 for 1/2 resolution, 1 for 1/4, ...) to draw the images
+    from their internal overviews instead of decoding them at full resolution.
+    """
     
     out = os.path.split(match_files_directory)[-1]
     output_directory = os.path.join(output_directory,out)
@@ -695,27 +753,34 @@ def plot_match_overlap(match_files_directory, images_directory, output_directory
     
     df_combined, keys = hsfm.qc.match_files_to_combined_df(matches)
         
+    # images often appear in several pairs, so read and stretch each only once
+    image_cache = {}
+    def _load(title):
+        if title not in image_cache:
+            image_file_name = hsfm.io.retrieve_match(title, images)
+            image = hsfm.image.read_image_gray(image_file_name, overview=overview)
+            # keep match coordinates in full resolution pixels when drawing an overview
+            width, height = _image_size(image_file_name)
+            extent = (-0.5, width-0.5, height-0.5, -0.5)
+            image_cache[title] = (image, np.percentile(image, (2,98)), extent)
+        return image_cache[title]
+    
     fig_size_y = len(matches)*3
-    fig, ax = plt.subplots(len(keys),2,figsize=(10,fig_size_y),sharex='col',sharey=True)
+    fig, ax = plt.subplots(len(keys),2,figsize=(10,fig_size_y),sharex='col',sharey=True,squeeze=False)
     for i,v in enumerate(keys):
         
         left_title = v.split('__')[0]
         right_title = v.split('__')[1]
         
-        ax[i][0].scatter(df_combined.xs(keys[i])['x1'], df_combined.xs(keys[i])['y1'],color='r',marker='.')
-        ax[i][1].scatter(df_combined.xs(keys[i])['x2'], df_combined.xs(keys[i])['y2'],color='r',marker='.')
+        df = df_combined.xs(v)
+        ax[i][0].scatter(df['x1'].values, df['y1'].values,color='r',marker='.',rasterized=True)
+        ax[i][1].scatter(df['x2'].values, df['y2'].values,color='r',marker='.',rasterized=True)
         
-        left_image = hsfm.io.retrieve_match(left_title, images)
-        left_image = gdal.Open(left_image)
-        left_image = left_image.ReadAsArray()
-        clim = np.percentile(left_image, (2,98))
-        ax[i][0].imshow(left_image, clim=clim, cmap='gray')
+        left_image, clim, extent = _load(left_title)
+        ax[i][0].imshow(left_image, clim=clim, cmap='gray', extent=extent)
         
-        right_image = hsfm.io.retrieve_match(right_title, images)
-        right_image = gdal.Open(right_image)
-        right_image = right_image.ReadAsArray()
-        clim = np.percentile(right_image, (2,98))
-        ax[i][1].imshow(right_image, clim=clim, cmap='gray')
+        right_image, clim, extent = _load(right_title)
+        ax[i][1].imshow(right_image, clim=clim, cmap='gray', extent=extent)
         
         ax[i][0].set_title(left_title)
         ax[i][1].set_title(right_title)
@@ -726,7 +791,8 @@ def plot_match_overlap(match_files_directory, images_directory, output_directory
     
     plt.tight_layout()
     out = os.path.join(output_directory,'match_plot.png')
-    plt.savefig(out)
+    fig.savefig(out, dpi=100)
+    plt.close(fig)
     return out
     
 def pick_camera_locations(image_directory, 
@@ -754,6 +820,49 @@ def pick_camera_locations(image_directory,
 
     return df
 
+def _iteration_output_files(output_path, iteration):
+    """
+    Returns output directory, bundle adjusted metadata file, aligned bundle adjusted
+    metadata file and clipped reference DEM file for a run_metashape iteration.
+    """
+    output_path = output_path.rstrip('/') + str(iteration)
+    return (output_path,
+            os.path.join(output_path,"bundle_adjusted_metadata.csv"),
+            os.path.join(output_path,"aligned_bundle_adjusted_metadata.csv"),
+            os.path.join(output_path,'reference_dem_clip.tif'))
+
+def _bbox_contains(outer, inner):
+    # bounds as (left, bottom, right, top)
+    ox0, oy0, ox1, oy1 = outer
+    ix0, iy0, ix1, iy1 = inner
+    return ox0 <= ix0 and oy0 <= iy0 and ox1 >= ix1 and oy1 >= iy1
+
+def _reference_dem_for(dem,
+                       reference_dem,
+                       clipped_reference_dem,
+                       reference_dem_clip = None,
+                       verbose            = False):
+    
+    # if the reference dem is smaller in extent than the to be aligned dem - don't clip it
+    # clipping is done to improve processing time as loading a large high-res reference dem
+    # into memory is costly at various succeeding steps
+    large_to_small_order = hsfm.geospatial.compare_dem_extent(dem, reference_dem)
+    if large_to_small_order != (reference_dem, dem):
+        return reference_dem
+    
+    if not isinstance(reference_dem_clip, type(None)) and \
+       os.path.exists(reference_dem_clip) and \
+       _bbox_contains(hsfm.io.load_dem_header(reference_dem_clip)['bounds'],
+                      hsfm.io.load_dem_header(dem)['bounds']):
+        print('Reusing clipped reference DEM', reference_dem_clip)
+        return reference_dem_clip
+    
+    return hsfm.utils.clip_reference_dem(dem,
+                                         reference_dem,
+                                         output_file_name = clipped_reference_dem,
+                                         buff_size        = 2000,
+                                         verbose          = verbose)
+
 def run_metashape(project_name,
                   images_path,
                   images_metadata_file,
@@ -773,13 +882,33 @@ def run_metashape(project_name,
                   verbose                 = False,
                   iteration               = 0,
                   cleanup                 = False,
-                  overwrite               = False):
+                  overwrite               = False,
+                  reference_dem_epsg_code = None,
+                  reference_dem_clip      = None,
+                  reuse_matches           = False):
+    """
+    Runs one metashape iteration and aligns the resulting DEM to reference_dem.
+    
+    reference_dem_clip is a reference DEM clipped in an earlier iteration. It is
+    reused instead of clipping the reference DEM again if it covers the new DEM.
+    
+    If reuse_matches is True and the project of the previous iteration exists, its
+    tie points are reused and only camera alignment and densification are run again.
+    """
     
     now = datetime.now()
     
-    output_path = output_path.rstrip('/') + str(iteration)
-    bundle_adjusted_metadata_file = os.path.join(output_path,"bundle_adjusted_metadata.csv")
-    aligned_bundle_adjusted_metadata_file = os.path.join(output_path,"aligned_bundle_adjusted_metadata.csv")
+    previous_metashape_project_file = None
+    if reuse_matches and iteration > 0:
+        previous_output_path = _iteration_output_files(output_path, iteration - 1)[0]
+        previous_metashape_project_file = os.path.join(previous_output_path, project_name + ".psx")
+        if not os.path.exists(previous_metashape_project_file):
+            previous_metashape_project_file = None
+    
+    output_path, \
+    bundle_adjusted_metadata_file, \
+    aligned_bundle_adjusted_metadata_file, \
+    clipped_reference_dem = _iteration_output_files(output_path, iteration)
     
     if not isinstance(metashape_licence_file, type(None)):
         hsfm.metashape.authentication(metashape_licence_file)
@@ -799,26 +928,38 @@ def run_metashape(project_name,
         print('Setting output DEM resolution to 10 m. You can regrid the las file to a higher resolution as desired.')
         output_DEM_resolution = 10
         
-    out = hsfm.metashape.images2las(project_name,
-                                    images_path,
-                                    images_metadata_file,
-                                    output_path,
-                                    focal_length            = focal_length,
-                                    pixel_pitch             = pixel_pitch,
-                                    camera_model_xml_file   = camera_model_xml_file,
-                                    image_matching_accuracy = image_matching_accuracy,
-                                    densecloud_quality      = densecloud_quality,
-                                    rotation_enabled        = rotation_enabled,
-                                    overwrite            = overwrite)
+    if not isinstance(previous_metashape_project_file, type(None)):
+        print('Reusing tie points from', previous_metashape_project_file)
+        out = hsfm.metashape.realign_images2las(previous_metashape_project_file,
+                                                project_name,
+                                                images_metadata_file,
+                                                output_path,
+                                                densecloud_quality      = densecloud_quality,
+                                                rotation_enabled        = rotation_enabled,
+                                                overwrite               = overwrite)
+    else:
+        out = hsfm.metashape.images2las(project_name,
+                                        images_path,
+                                        images_metadata_file,
+                                        output_path,
+                                        focal_length            = focal_length,
+                                        pixel_pitch             = pixel_pitch,
+                                        camera_model_xml_file   = camera_model_xml_file,
+                                        image_matching_accuracy = image_matching_accuracy,
+                                        densecloud_quality      = densecloud_quality,
+                                        rotation_enabled        = rotation_enabled,
+                                        overwrite            = overwrite)
     
     metashape_project_file, point_cloud_file = out
     
+    # input positions are parsed once and compared in memory with the bundle adjusted positions
+    images_metadata_df = pd.read_csv(images_metadata_file)
     ba_cameras_df, unaligned_cameras_df = hsfm.metashape.update_ba_camera_metadata(metashape_project_file,
-                                                                                   images_metadata_file)
-    ba_cameras_df.to_csv(bundle_adjusted_metadata_file, index = False)
+                                                                                   images_metadata_df)
+    ba_cameras_df.to_csv(bundle_adjusted_metadata_file, index = False, float_format = '%.8f')
 
-    x_offset, y_offset, z_offset = hsfm.core.compute_point_offsets(images_metadata_file, 
-                                                                   bundle_adjusted_metadata_file)
+    x_offset, y_offset, z_offset = hsfm.core.compute_point_offsets(images_metadata_df, 
+                                                                   ba_cameras_df)
 
 
     ba_CE90, ba_LE90 = hsfm.geospatial.CE90(x_offset,y_offset), hsfm.geospatial.LE90(z_offset)
@@ -838,7 +979,9 @@ def run_metashape(project_name,
     else:
         print("\nCan't find reference DEM at",output_path)
         sys.exit(0) 
-    epsg_code = 'EPSG:'+ hsfm.geospatial.get_epsg_code(reference_dem)
+    if isinstance(reference_dem_epsg_code, type(None)):
+        reference_dem_epsg_code = hsfm.geospatial.get_epsg_code(reference_dem)
+    epsg_code = 'EPSG:'+ str(reference_dem_epsg_code)
     dem = hsfm.asp.point2dem(point_cloud_file,
                              '--nodata-value','-9999',
                              '--tr',str(output_DEM_resolution),
@@ -852,18 +995,11 @@ def run_metashape(project_name,
         # further attempted alignment is unlikely to change the result,
         # if it was unsuccessful to begin with.
 
-        clipped_reference_dem = os.path.join(output_path,'reference_dem_clip.tif')
-        
-        # if the reference dem is smaller in extent than the to be aligned dem - don't clip it
-        # clipping is done to improve processing time as loading a large high-res reference dem
-        # into memory is costly at various succeeding steps
-        large_to_small_order = hsfm.geospatial.compare_dem_extent(dem, reference_dem)
-        if large_to_small_order == (reference_dem, dem):
-            reference_dem = hsfm.utils.clip_reference_dem(dem,
-                                                          reference_dem,
-                                                          output_file_name = clipped_reference_dem,
-                                                          buff_size        = 2000,
-                                                          verbose = verbose)
+        reference_dem = _reference_dem_for(dem,
+                                           reference_dem,
+                                           clipped_reference_dem,
+                                           reference_dem_clip = reference_dem_clip,
+                                           verbose            = verbose)
 
         aligned_dem_file, transform =  hsfm.asp.pc_align_p2p_sp2p(dem, 
                                                                   reference_dem,
@@ -872,12 +1008,13 @@ def run_metashape(project_name,
 
         print("Elapsed time", str(datetime.now() - now))
 
-        hsfm.core.metadata_transform(bundle_adjusted_metadata_file,
-                                     transform,
-                                     output_file_name=aligned_bundle_adjusted_metadata_file)
+        # the transformed metadata is written once and reused in memory for the offsets
+        aligned_ba_cameras_df = hsfm.core.metadata_transform(ba_cameras_df,
+                                                             transform,
+                                                             output_file_name=aligned_bundle_adjusted_metadata_file)
 
-        x_offset, y_offset, z_offset  = hsfm.core.compute_point_offsets(bundle_adjusted_metadata_file,
-                                                                        aligned_bundle_adjusted_metadata_file)
+        x_offset, y_offset, z_offset  = hsfm.core.compute_point_offsets(ba_cameras_df,
+                                                                        aligned_ba_cameras_df)
 
         tr_ba_CE90, tr_ba_LE90 = hsfm.geospatial.CE90(x_offset,y_offset), hsfm.geospatial.LE90(z_offset)
 
@@ -911,14 +1048,19 @@ def run_metashape(project_name,
 
     else:
         dem_align_output_path,_,_ = hsfm.io.split_file(dem)
-        hsfm.utils.dem_align_custom(reference_dem,
-                                    dem,
-                                    verbose = verbose)
-        if generate_ortho:
-            ortho_output_path,_,_ = hsfm.io.split_file(dem)
-
-            hsfm.metashape.images2ortho(project_name,
-                                        ortho_output_path)
+        # dem_align.py runs as a subprocess on a worker thread, while the
+        # metashape api stays on this thread to build the orthomosaic
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+            future = executor.submit(hsfm.utils.dem_align_custom,
+                                     reference_dem,
+                                     dem,
+                                     verbose = verbose)
+            if generate_ortho:
+                ortho_output_path,_,_ = hsfm.io.split_file(dem)
+
+                hsfm.metashape.images2ortho(project_name,
+                                            ortho_output_path)
+            future.result()
         
         output = [bundle_adjusted_metadata_file, 
                   ba_CE90, 
@@ -954,15 +1096,38 @@ def metaflow(project_name,
              cleanup                 = False,
              check_subsets           = True,
              attempts_to_adjust_cams = 2,
-             overwrite               = False):
+             overwrite               = False,
+             reuse_matches           = False):
+    """
+    Runs run_metashape iteratively, processing subset clusters and unaligned images separately.
+    
+    With reuse_matches, iterations after the first reuse the tie points of the previous
+    iteration's project instead of matching the photos again.
+    """
 
     if not isinstance(metashape_licence_file, type(None)):
         hsfm.metashape.authentication(metashape_licence_file)
+    hsfm.metashape.check_metashape()
+    
+    # the reference dem epsg code is looked up once here and passed to every
+    # run_metashape iteration and sub cluster below
+    reference_dem_epsg_code = None
+    # the reference dem clipped in the first iteration is reused while it covers later DEMs
+    reference_dem_clip      = _iteration_output_files(output_path, 0)[-1]
+    if os.path.exists(reference_dem):
+        reference_dem_epsg_code = hsfm.geospatial.get_epsg_code(reference_dem)
         
     # read from metadata file if not specified
+    # the file is parsed once and shared by the focal length and pixel pitch lookups
+    df_tmp = None
+    if isinstance(camera_model_xml_file, type(None)) and \
+       (isinstance(focal_length, type(None)) or isinstance(pixel_pitch, type(None))):
+        try:
+            df_tmp = pd.read_csv(images_metadata_file)
+        except:
+            pass
     if isinstance(focal_length, type(None)) and isinstance(camera_model_xml_file, type(None)):
         try:
-            df_tmp        = pd.read_csv(images_metadata_file)
             focal_lengths = df_tmp['focal_length'].values
             if len(set(focal_lengths)) == 1:
                 focal_length = focal_lengths[0]
@@ -977,7 +1142,6 @@ def metaflow(project_name,
             pass
     if isinstance(pixel_pitch, type(None)) and isinstance(camera_model_xml_file, type(None)):
         try:
-            df_tmp        = pd.read_csv(images_metadata_file)
             pixel_pitches = df_tmp['pixel_pitch'].values
             if len(set(pixel_pitches)) == 1:
                 pixel_pitch = pixel_pitches[0]
@@ -1018,12 +1182,12 @@ def metaflow(project_name,
             print(len(subsets), 'image cluster subsets detected')
             image_file_names = list(ba_cameras_df['image_file_name'].values)
             cameras_sub_clusters_dfs = []
+            images_metadata_df = pd.read_csv(images_metadata_file)
             for sub in subsets:
                 tmp    = hsfm.core.select_strings_with_sub_strings(image_file_names, sub)
                 ## might be better to restart with the original input positions as subset could be displaced
                 ## after matching without actually connecting to the other cluster.
-                tmp_df = pd.read_csv(images_metadata_file)
-                tmp_df = tmp_df[tmp_df['image_file_name'].isin(tmp)].reset_index(drop=True)
+                tmp_df = images_metadata_df[images_metadata_df['image_file_name'].isin(tmp)].reset_index(drop=True)
 #                 tmp_df = ba_cameras_df[ba_cameras_df['image_file_name'].isin(tmp)].reset_index(drop=True)
                 cameras_sub_clusters_dfs.append(tmp_df)
 
@@ -1057,7 +1221,8 @@ def metaflow(project_name,
                                     cleanup                 = cleanup,
                                     check_subsets           = False,
                                     attempts_to_adjust_cams = attempts_to_adjust_cams,
-                                       overwrite            = overwrite)
+                                       overwrite            = overwrite,
+                                       reuse_matches           = reuse_matches)
                 except:
                     pass
 
@@ -1084,7 +1249,8 @@ def metaflow(project_name,
                                            verbose                 = verbose,
                                            iteration               = 0,
                                            cleanup                 = cleanup,
-                                           overwrite            = overwrite)
+                                           overwrite            = overwrite,
+                                           reference_dem_epsg_code = reference_dem_epsg_code)
 
             bundle_adjusted_metadata_file,\
             ba_CE90,\
@@ -1117,7 +1283,10 @@ def metaflow(project_name,
                                                        verbose                 = verbose,
                                                        iteration               = i,
                                                        cleanup                 = cleanup,
-                                                       overwrite            = overwrite)
+                                                       overwrite            = overwrite,
+                                                       reference_dem_epsg_code = reference_dem_epsg_code,
+                                                       reference_dem_clip      = reference_dem_clip,
+                                                       reuse_matches           = reuse_matches)
 
                         bundle_adjusted_metadata_file,\
                         ba_CE90,\
@@ -1163,7 +1332,8 @@ def metaflow(project_name,
                                 cleanup                 = cleanup,
                                 check_subsets           = check_subsets,
                                 attempts_to_adjust_cams = attempts_to_adjust_cams,
-                                overwrite            = overwrite)
+                                overwrite            = overwrite,
+                                reuse_matches           = reuse_matches)
         if cleanup == True:
             las_files = glob.glob(os.path.join(output_path,'**/*.las'), recursive=True)
             for i in las_files:
@@ -1189,7 +1359,8 @@ def metaflow(project_name,
                                        verbose                 = verbose,
                                        iteration               = 0,
                                        cleanup                 = cleanup,
-                                       overwrite            = overwrite)
+                                       overwrite            = overwrite,
+                                       reference_dem_epsg_code = reference_dem_epsg_code)
 
         bundle_adjusted_metadata_file,\
         ba_CE90,\
@@ -1222,7 +1393,10 @@ def metaflow(project_name,
                                                    verbose                 = verbose,
                                                    iteration               = i,
                                                    cleanup                 = cleanup,
-                                                   overwrite            = overwrite)
+                                                   overwrite            = overwrite,
+                                                   reference_dem_epsg_code = reference_dem_epsg_code,
+                                                   reference_dem_clip      = reference_dem_clip,
+                                                   reuse_matches           = reuse_matches)
 
                     bundle_adjusted_metadata_file,\
                     ba_CE90,\
@@ -1238,6 +1412,45 @@ def metaflow(project_name,
             for i in las_files:
                 os.remove(i)
 
+def _metaflow_one(batch_directory,
+                  project_name,
+                  image_files,
+                  reference_dem,
+                  camera_models,
+                  **kwargs):
+    
+    """
+    Runs metaflow for one batch and returns None, or the error message if it failed.
+    Defined at top level so batches can be sent to worker processes.
+    """
+    now   = datetime.now()
+    error = None
+    try:
+        print('\n\n'+batch_directory)
+
+        cluster_project_name = project_name+'_'+os.path.basename(batch_directory)
+
+        images_metadata_file = os.path.join(batch_directory,'metashape_metadata.csv')
+        output_path          = os.path.join(batch_directory,'metashape')
+
+        hsfm.batch.metaflow(cluster_project_name,
+                            image_files,
+                            images_metadata_file,
+                            reference_dem,
+                            output_path,
+                            camera_model_xml_file = camera_models,
+                            **kwargs)
+    except (Exception, SystemExit):
+        # metaflow exits on some failures, which must not end the remaining batches
+        error = traceback.format_exc()
+        print('FAIL:', batch_directory)
+        print(error)
+
+    print('\n\n'+batch_directory)
+    print("Elapsed time", str(datetime.now() - now), '\n\n')
+    print("DONE")
+    return error
+
 def batch_process(project_name,
                   reference_dem,
                   input_directory         ='../',
@@ -1252,7 +1465,19 @@ def batch_process(project_name,
                   cleanup                 = True,
                   attempts_to_adjust_cams = 2,
                   check_subsets           = True,
-                  overwrite               = False):
+                  overwrite               = False,
+                  plot_LE90_CE90          = True,
+                  reuse_matches           = False,
+                  max_workers             = 1):
+    """
+    Runs hsfm.batch.metaflow for each cluster batch found under input_directory.
+    
+    Batches are independent of each other and can be processed in parallel by
+    setting max_workers > 1. Each worker checks out a Metashape licence, so
+    max_workers should not exceed the number of licence seats available.
+    
+    Set plot_LE90_CE90 to False to skip the camera offset qc plots on headless runs.
+    """
     
     output_directory = os.path.join(input_directory, project_name, 'input_data')
     
@@ -1278,41 +1503,43 @@ def batch_process(project_name,
     else:
         print("\nCan't find reference DEM at",output_path)
         sys.exit(0) 
-    for i in batches:
-        
-        ## TODO add better logging here and print the error message
-        try:
-            print('\n\n'+i)
-
-            now = datetime.now()
-
-            cluster_project_name = project_name+'_'+os.path.basename(i)
-
-            images_metadata_file = os.path.join(i,'metashape_metadata.csv')
-            output_path          = os.path.join(i,'metashape')
-
-            hsfm.batch.metaflow(cluster_project_name,
-                                image_files,
-                                images_metadata_file,
-                                reference_dem,
-                                output_path,
-                                pixel_pitch,
-                                camera_model_xml_file   = camera_models,
-                                output_DEM_resolution   = output_DEM_resolution,
-                                generate_ortho          = generate_ortho,
-                                dem_align_all           = dem_align_all,
-                                image_matching_accuracy = image_matching_accuracy,
-                                densecloud_quality      = densecloud_quality,
-                                metashape_licence_file  = metashape_licence_file,
-                                verbose                 = verbose,
-                                cleanup                 = cleanup,
-                                attempts_to_adjust_cams = attempts_to_adjust_cams,
-                                check_subsets           = check_subsets,
-                                overwrite               = overwrite)
-        except:
-            print('FAIL:', i)
-
-        print('\n\n'+i)
-        print("Elapsed time", str(datetime.now() - now), '\n\n')
-        print("DONE")
-
+    
+    # fail once here instead of in every batch, as failures inside batches are skipped
+    if not isinstance(metashape_licence_file, type(None)):
+        hsfm.metashape.authentication(metashape_licence_file)
+    hsfm.metashape.check_metashape()
+    
+    worker = functools.partial(_metaflow_one,
+                               project_name            = project_name,
+                               image_files             = image_files,
+                               reference_dem           = reference_dem,
+                               camera_models           = camera_models,
+                               pixel_pitch             = pixel_pitch,
+                               output_DEM_resolution   = output_DEM_resolution,
+                               generate_ortho          = generate_ortho,
+                               dem_align_all           = dem_align_all,
+                               image_matching_accuracy = image_matching_accuracy,
+                               densecloud_quality      = densecloud_quality,
+                               metashape_licence_file  = metashape_licence_file,
+                               verbose                 = verbose,
+                               cleanup                 = cleanup,
+                               attempts_to_adjust_cams = attempts_to_adjust_cams,
+                               check_subsets           = check_subsets,
+                               overwrite               = overwrite,
+                               plot_LE90_CE90          = plot_LE90_CE90,
+                               reuse_matches           = reuse_matches)
+    
+    if max_workers == 1:
+        errors = [worker(i) for i in batches]
+    else:
+        # spawn fresh workers, so they don't inherit the Metashape library
+        # state loaded in this process by check_metashape
+        with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers,
+                                                    mp_context=multiprocessing.get_context('spawn')) as executor:
+            errors = list(executor.map(worker, batches))
+    
+    failed = [batch for batch, error in zip(batches, errors) if error is not None]
+    if failed:
+        print('\nFailed batches:')
+        for batch in failed:
+            print(batch)
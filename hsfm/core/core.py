@@ -3,20 +3,25 @@ import numpy as np
 import math
 import pandas as pd
 from urllib.request import urlopen
+from urllib.error import HTTPError
 import cv2
 from skimage import exposure
 import shapely
 import glob
 import os
 from osgeo import gdal
+import rasterio
 import utm
 import itertools
+import functools
 import geopandas as gpd
 import pathlib
+import pyproj
 import matplotlib.pyplot as plt
 import matplotlib._color_data as mcd
 import contextily as ctx
 import time
+import uuid
 cycle = list(mcd.XKCD_COLORS.values())
 
 import hsfm
@@ -29,6 +34,22 @@ Core data wrangling and preprocessing functions.
 # TODO
 # - break this up into seperate libraries and classes to better
 #   accomodate other imagery and generealize upstream as much as possible.
+
+# column types of the camera metadata csv files passed between processing steps,
+# given to pandas so they are parsed directly without type inference
+_METADATA_DTYPES = {'image_file_name': str,
+                    'lon'            : 'float64',
+                    'lat'            : 'float64',
+                    'alt'            : 'float64',
+                    'lon_acc'        : 'float64',
+                    'lat_acc'        : 'float64',
+                    'alt_acc'        : 'float64',
+                    'yaw'            : 'float64',
+                    'pitch'          : 'float64',
+                    'roll'           : 'float64',
+                    'yaw_acc'        : 'float64',
+                    'pitch_acc'      : 'float64',
+                    'roll_acc'       : 'float64'}
     
 def get_gcp_polygon(fn):
     
@@ -288,9 +309,9 @@ def prep_and_generate_gcp(image_file_name,
     image_base_name = os.path.splitext(os.path.split(image_file_name)[-1])[0]
     
     # Read in the image and get the dimensions and principal point at image center
-    img_ds = gdal.Open(image_file_name)
-    image_width_px = img_ds.RasterXSize
-    image_height_px = img_ds.RasterYSize
+    with rasterio.open(image_file_name) as src:
+        image_width_px = src.width
+        image_height_px = src.height
     principal_point_px = (image_width_px/2, image_height_px/2)
     
     # Calculate corner coordinates and elevations
@@ -547,12 +568,36 @@ def subset_images_for_download(df, subset=None):
             df = df[df['image_index_number'].isin(subset)]
     return df
     
-def download_image(pid):
+def download_image(pid, max_retries=5):
     base_url = 'https://arcticdata.io/metacat/d1/mn/v2/object/'
     url = base_url+pid
-    resp = urlopen(url)
-    image = np.asarray(bytearray(resp.read()), dtype="uint8")
-    image = cv2.imdecode(image, cv2.IMREAD_GRAYSCALE)
+    for attempt in range(max_retries):
+        try:
+            resp = urlopen(url)
+            break
+        except HTTPError as e:
+            # back off when the server rate limits concurrent downloads
+            if e.code != 429 or attempt == max_retries-1:
+                raise
+            try:
+                wait = float(e.headers.get('Retry-After'))
+            except (TypeError, ValueError):
+                wait = 2**attempt
+            time.sleep(wait)
+    data = resp.read()
+    
+    if data[:4] in (b'II*\x00', b'MM\x00*', b'II+\x00', b'MM\x00+'):
+        # read tiffs through GDAL's in-memory file system, so only the
+        # needed band is decoded and nothing is written to a temporary file
+        vsimem_file_name = '/vsimem/'+str(uuid.uuid4())+'.tif'
+        gdal.FileFromMemBuffer(vsimem_file_name, data)
+        try:
+            image = hsfm.image.read_image_gray(vsimem_file_name)
+        finally:
+            gdal.Unlink(vsimem_file_name)
+    else:
+        image = np.frombuffer(data, dtype="uint8")
+        image = cv2.imdecode(image, cv2.IMREAD_GRAYSCALE)
     return image
     
 def slice_image_frame(grayscale_unit8_image_array, windows):
@@ -737,10 +782,7 @@ def preprocess_image(image_array,
                                              crop_from_pp_dist = crop_from_pp_dist)
         img_rot = hsfm.core.rotate_camera(cropped, side=side)
         out = os.path.join(output_directory, file_name+'.tif')
-        cv2.imwrite(out,img_rot)
-        final_output = hsfm.utils.optimize_geotif(out)
-        os.remove(out)
-        os.rename(final_output, out)
+        hsfm.utils.write_geotif(img_rot, out)
         
         
     if qc == True:
@@ -910,11 +952,17 @@ def get_fiducial(grayscale_unit8_image_array,template_file, window, position = N
         y = window[0] + loc[0][0] - 250
         return x,y
         
+@functools.lru_cache(maxsize=None)
+def _load_template(template_file):
+    # read and stretch each template once per process; callers get a copy
+    # since noisify_template modifies the array in place.
+    template = cv2.imread(template_file, cv2.IMREAD_GRAYSCALE)
+    template = hsfm.image.img_linear_stretch(template)
+    return template
+
 def template_match(grayscale_unit8_image_array,template_file):
     img_gray = grayscale_unit8_image_array
-    template = cv2.imread(template_file)
-    template = cv2.cvtColor(template,cv2.COLOR_BGR2GRAY)
-    template = hsfm.image.img_linear_stretch(template)
+    template = _load_template(template_file).copy()
     template = hsfm.core.noisify_template(template)
     w, h = template.shape[::-1]
     res = cv2.matchTemplate(img_gray,template,cv2.TM_CCOEFF_NORMED)
@@ -1185,32 +1233,30 @@ def metadata_transform(metadata_file,
     
     '''
     Applies pc_align transform to lat, lon, alt positions.
+    metadata_file can be a csv file or a DataFrame already in memory.
     '''
-    metadata_df = pd.read_csv(metadata_file)
-    df = hsfm.geospatial.df_xyz_coords_to_gdf(metadata_df, z='alt')
-    df = df.to_crs('epsg:4978')
-    hsfm.geospatial.extract_gpd_geometry(df)
-    
-    df_tmp = pd.DataFrame()
-    for index, row in df.iterrows():
-        C = [row.x,row.y,row.z]
-        C_translation, R_transform = hsfm.core.extract_transform(pc_align_transform_file)
-        row.x,row.y,row.z = hsfm.core.apply_position_transform(C, C_translation, R_transform)
-
-        row = row.drop(['geometry'])
-        df_tmp = df_tmp.append(row)
-        
-    transformed_metadata = hsfm.geospatial.df_xyz_coords_to_gdf(df_tmp, 
-                                                                lon='x', 
-                                                                lat= 'y', 
-                                                                z='z',
-                                                                epsg_code='4978')
-
-    transformed_metadata = transformed_metadata.to_crs('epsg:4326')
-    hsfm.geospatial.extract_gpd_geometry(transformed_metadata)
-
-    transformed_metadata[['lon', 'lat','alt']] = transformed_metadata[['x', 'y','z']]
-    transformed_metadata = transformed_metadata.drop(['x', 'y','z', 'geometry'], axis=1)
+    metadata_df = _metadata_to_df(metadata_file)
+    
+    # transform the coordinate arrays directly, without building shapely geometries
+    to_ecef = pyproj.Transformer.from_crs('epsg:4326', 'epsg:4978', always_xy=True)
+    to_geographic = pyproj.Transformer.from_crs('epsg:4978', 'epsg:4326', always_xy=True)
+    
+    x, y, z = to_ecef.transform(metadata_df['lon'].values,
+                                metadata_df['lat'].values,
+                                metadata_df['alt'].values)
+    
+    # read the transform once and apply it to all positions at once
+    C_translation, R_transform = hsfm.core.extract_transform(pc_align_transform_file)
+    C = np.column_stack([x, y, z])
+    C = C @ np.array(R_transform, dtype=float).T + np.array(C_translation, dtype=float)
+    
+    lon, lat, alt = to_geographic.transform(C[:,0], C[:,1], C[:,2])
+    
+    transformed_metadata = metadata_df.copy()
+    transformed_metadata['lon'] = lon
+    transformed_metadata['lat'] = lat
+    transformed_metadata['alt'] = alt
+    
     transformed_metadata = transformed_metadata[['image_file_name', 
                                                  'lon', 
                                                  'lat', 
@@ -1228,7 +1274,8 @@ def metadata_transform(metadata_file,
     transformed_metadata = transformed_metadata.sort_values(by=['image_file_name'], ascending=True)
     
     if not isinstance(output_file_name, type(None)):
-        transformed_metadata.to_csv(output_file_name, index = False)
+        # 8 decimals is about 1 mm in lon and lat and writes faster than the full float repr
+        transformed_metadata.to_csv(output_file_name, index = False, float_format = '%.8f')
     
     return transformed_metadata
 
@@ -1256,31 +1303,48 @@ def compute_point_offsets(metadata_file_1,
                           lon       = 'lon',
                           lat       = 'lat',
                           alt       = 'alt'):
+    '''
+    Returns x, y, z offsets between camera positions. Inputs can be csv files or
+    DataFrames already in memory, to avoid parsing the same metadata again.
+    '''
     
-    df1 = pd.read_csv(metadata_file_1)
-    df2 = pd.read_csv(metadata_file_2)
+    df1 = _metadata_to_df(metadata_file_1)
+    df2 = _metadata_to_df(metadata_file_2)
     
-    # make dataframes contain only entries for union of image file names in each. 
-    if len(df1) > len(df2):
-        df1 = df1[df1['image_file_name'].isin(df2['image_file_name'].values)].reset_index(drop=True)
-    elif len(df1) < len(df2):
-        df2 = df2[df2['image_file_name'].isin(df1['image_file_name'].values)].reset_index(drop=True)
+    # pair up entries by image file name, so each offset compares the same camera
+    df = pd.merge(df1[['image_file_name', lon, lat, alt]],
+                  df2[['image_file_name', lon, lat, alt]],
+                  on='image_file_name',
+                  how='inner',
+                  suffixes=('_1', '_2'))
         
-    epsg_code = hsfm.geospatial.lon_lat_to_utm_epsg_code(df2[lon].values[0], df2[lat].values[0])
-    gdf1 = hsfm.geospatial.df_xy_coords_to_gdf(df1, lon=lon, lat=lat)
-    gdf1 = gdf1.to_crs('epsg:'+epsg_code)
-    hsfm.geospatial.extract_gpd_geometry(gdf1)
-    
+    epsg_code = hsfm.geospatial.lon_lat_to_utm_epsg_code(df[lon+'_2'].values[0], df[lat+'_2'].values[0])
+    to_utm = pyproj.Transformer.from_crs('epsg:4326', 'epsg:'+epsg_code, always_xy=True)
     
-    gdf2 = hsfm.geospatial.df_xy_coords_to_gdf(df2, lon=lon, lat=lat)
-    gdf2 = gdf2.to_crs('epsg:'+epsg_code)
-    hsfm.geospatial.extract_gpd_geometry(gdf2)
+    x1, y1 = to_utm.transform(df[lon+'_1'].values, df[lat+'_1'].values)
+    x2, y2 = to_utm.transform(df[lon+'_2'].values, df[lat+'_2'].values)
     
-    x_offset = gdf1.x - gdf2.x
-    y_offset = gdf1.y - gdf2.y
-    z_offset = gdf1.alt - gdf2.alt
+    x_offset = pd.Series(x1 - x2)
+    y_offset = pd.Series(y1 - y2)
+    z_offset = df[alt+'_1'] - df[alt+'_2']
     
     return x_offset, y_offset, z_offset
+
+def _metadata_to_df(metadata):
+    if isinstance(metadata, pd.DataFrame):
+        return metadata.reset_index(drop=True)
+    
+    # only set dtypes for columns present in this file, as not every metadata csv has all of them
+    columns = pd.read_csv(metadata, nrows=0).columns
+    dtypes  = {k: v for k, v in _METADATA_DTYPES.items() if k in columns}
+    
+    # use the multithreaded pyarrow csv parser when it is installed
+    try:
+        import pyarrow
+        return pd.read_csv(metadata, dtype=dtypes, engine='pyarrow')
+    except (ImportError, ValueError):
+        # ValueError if the pandas version does not provide the pyarrow engine
+        return pd.read_csv(metadata, dtype=dtypes)
     
 
 def find_sets(lsts):
@@ -1545,7 +1609,10 @@ def estimate_DEM_resolution_from_GSD(images_metadata_file,
                                      focal_length,
                                      factor=3):
     
-    df = pd.read_csv(images_metadata_file)
+    # only the camera positions are needed
+    df = pd.read_csv(images_metadata_file,
+                     usecols=['lon', 'lat', 'alt'],
+                     dtype={'lon': 'float64', 'lat': 'float64', 'alt': 'float64'})
     elevations = hsfm.geospatial.USGS_elevation_function(df['lat'].values, df['lon'].values)
     mean_camera_alt_above_ground = (df['alt'].values - np.array(elevations)).mean()
     GSD = hsfm.core.compute_GSD(mean_camera_alt_above_ground, pixel_pitch, focal_length)
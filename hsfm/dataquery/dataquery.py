@@ -1,6 +1,7 @@
 import contextily as ctx
 import fsspec
 import geopandas as gpd
+import pandas as pd
 import os
 import glob
 import shutil
@@ -11,13 +12,19 @@ from datetime import datetime
 from subprocess import Popen, PIPE, STDOUT
 import pathlib
 import json
-from shapely.geometry import Polygon
+import concurrent.futures
+import time
+from shapely.geometry import Polygon, box, shape
 import matplotlib.pyplot as plt
 import psutil
 import numpy as np
 import hsfm
 
 
+# logical cpu count, passed as thread count to pdal and asp tools
+_N_CPU = str(psutil.cpu_count(logical=True) or os.cpu_count() or 1)
+
+
 ##### 3DEP AWS lidar #####
 # TODO
 # - make this a class to reduce passing redundant inputs
@@ -34,10 +41,21 @@ def process_3DEP_laz_to_DEM(
     dem_resolution = 1,
     cache_directory="cache",
     dry_run=False,
+    grid_with_pdal=False,
+    with_basemap=False,
+    boundaries_gdf=None,
+    pdal_threads=None,
 ):
     """
     Processes first,only lidar returns to DSM.
     
+    If with_basemap is True, the qc plots include a satellite basemap, with tiles
+    cached in cache_directory.
+    
+    If grid_with_pdal is True, points are gridded by PDAL (writers.gdal, idw) while
+    streaming from the EPT source, instead of writing laz files and gridding them
+    with point2dem.
+    
     Finds boundary.json files available at http://usgs-lidar-public.s3.amazonaws.com/*/
     
     Directories that do not have a boundary.json file at the top level are omitted.
@@ -51,6 +69,11 @@ def process_3DEP_laz_to_DEM(
     
     No additional horizontal and vertical crs transformations are performed.
     
+    boundaries_gdf: output of load_3DEP_boundaries(), shared across calls to avoid 
+                    re-reading the boundary cache for every tile.
+    
+    pdal_threads: threads used by each PDAL reader. Defaults to all cpus.
+    
     bounds = [east, south, west, north]
     
     """
@@ -60,9 +83,12 @@ def process_3DEP_laz_to_DEM(
     
     start = datetime.now()
 
-    pathlib.Path(output_path).mkdir(parents=True, exist_ok=True)
+    output_path = pathlib.Path(output_path)
+    output_path.mkdir(parents=True, exist_ok=True)
+    if isinstance(boundaries_gdf, type(None)):
+        boundaries_gdf = hsfm.dataquery.load_3DEP_boundaries(cache_directory=cache_directory)
     result_gdf, bounds_gdf = hsfm.dataquery.get_3DEP_lidar_data_dirs(
-        bounds, cache_directory=cache_directory
+        bounds, cache_directory=cache_directory, boundaries_gdf=boundaries_gdf
     )
 
     if not epsg_code:
@@ -84,9 +110,15 @@ def process_3DEP_laz_to_DEM(
             print(message)
             return None
 
-    hsfm.dataquery.plot_3DEP_bounds(
-        result_gdf, bounds_gdf, qc_plot_output_directory=output_path
-    )
+    # the overview plot is only needed to choose between directories
+    if not aws_3DEP_directory or len(result_gdf.index) > 1:
+        hsfm.dataquery.plot_3DEP_bounds(
+            result_gdf, 
+            bounds_gdf, 
+            qc_plot_output_directory=output_path,
+            with_basemap=with_basemap,
+            cache_directory=cache_directory,
+        )
 
     if len(result_gdf.index) != 1:
         print(
@@ -133,6 +165,8 @@ def process_3DEP_laz_to_DEM(
             bounds_gdf,
             tile_polygons_gdf=tile_polygons_gdf,
             qc_plot_output_directory=output_path,
+            with_basemap=with_basemap,
+            cache_directory=cache_directory,
         )
         
         if not dry_run: 
@@ -145,80 +179,83 @@ def process_3DEP_laz_to_DEM(
                 # however it might not be adding much speed improvement, so requesting in parallel
                 # with single threaded PDAL calls might be faster.
                 result_gdf, bounds_gdf = hsfm.dataquery.get_3DEP_lidar_data_dirs(
-                    tile, cache_directory=cache_directory
+                    tile, cache_directory=cache_directory, boundaries_gdf=boundaries_gdf
                 )
                 try:
-                    output_path_tmp = os.path.join(output_path, str(c).zfill(5))
-                    pathlib.Path(output_path_tmp).mkdir(parents=True, exist_ok=True)
-
-                    (pipeline_json_file,output_laz_file,
+                    output_path_tmp = output_path / str(c).zfill(5)
+                    output_path_tmp.mkdir(parents=True, exist_ok=True)
+
+                    if grid_with_pdal:
+                        pipeline_dem_file = "output-DEM.tif"
+                    else:
+                        pipeline_dem_file = None
+                    
+                    (pipeline_json_file,output_file,
                     ) = hsfm.dataquery.create_3DEP_pipeline(
                         bounds_gdf,
                         aws_3DEP_directory,
                         epsg_code,
-                        output_path=output_path_tmp,
+                        output_path=str(output_path_tmp),
+                        output_dem_file=pipeline_dem_file,
+                        dem_resolution=dem_resolution,
+                        threads=pdal_threads,
                     )
 
                     hsfm.dataquery.run_3DEP_pdal_pipeline(
                         pipeline_json_file, verbose=verbose
                     )
-                    print(output_laz_file)
-
-#                     output_dem_file = hsfm.dataquery.grid_3DEP_laz(output_laz_file, 
-#                                                                    epsg_code, 
-#                                                                    dem_resolution=dem_resolution,
-#                                                                    verbose=verbose)
-                    output_dem_file = grid_3DEP_multi_laz(
-                        output_path_tmp, 
-                        epsg_code, 
-                        dem_resolution=dem_resolution,
-                        verbose=verbose
-                    )
-
-                    out = os.path.join(output_path_tmp, DEM_file_name)
-                    os.rename(output_dem_file, out)
+                    print(output_file)
+
+                    if grid_with_pdal:
+                        output_dem_file = output_file
+                    else:
+#                         output_dem_file = hsfm.dataquery.grid_3DEP_laz(output_file, 
+#                                                                        epsg_code, 
+#                                                                        dem_resolution=dem_resolution,
+#                                                                        verbose=verbose)
+                        output_dem_file = grid_3DEP_multi_laz(
+                            str(output_path_tmp), 
+                            epsg_code, 
+                            dem_resolution=dem_resolution,
+                            verbose=verbose
+                        )
+
+                    pathlib.Path(output_dem_file).replace(output_path_tmp / DEM_file_name)
 
                     if cleanup == True:
-                        files = glob.glob(os.path.join(output_path_tmp, "*.laz"))
-                        for i in files:
-                            os.remove(i)
-                        os.remove(pipeline_json_file)
-                        files = glob.glob(os.path.join(output_path_tmp, "*log*.txt"))
-                        for i in files:
-                            os.remove(i)
-                        files = glob.glob(os.path.join(output_path_tmp, "output*-DEM.tif"))
-                        for i in files:
-                            os.remove(i)
+                        for i in output_path_tmp.glob("*.laz"):
+                            i.unlink()
+                        pathlib.Path(pipeline_json_file).unlink()
+                        for i in output_path_tmp.glob("*log*.txt"):
+                            i.unlink()
+                        for i in output_path_tmp.glob("output*-DEM.tif"):
+                            i.unlink()
                     c += 1
                 except:
                     c += 1
 #                     shutil.rmtree(output_path_tmp)
                     pass
 
-            tmp = os.path.join(output_path, "*/*"+DEM_file_name)
-            output_dem_file = os.path.join(output_path, DEM_file_name)
+            tmp = str(output_path / ("*/*"+DEM_file_name))
+            output_dem_file = str(output_path / DEM_file_name)
             
             #TODO mosaic with gdal instead of ASP dem_mosaic
             call = [
                 "dem_mosaic",
                 tmp,
                 "--threads",
-                str(psutil.cpu_count(logical=True)),
+                _N_CPU,
                 "-o",
                 output_dem_file,
             ]
             call = " ".join(call)
             hsfm.utils.run_command2(call)
             if cleanup == True:
-                files = glob.glob(tmp)
-                for i in files:
-                    dir_path = str(pathlib.Path(i).parent.resolve())
-                    shutil.rmtree(dir_path)
-                files = glob.glob(os.path.join(output_path, "*log*.txt"))
-                for i in files:
-                    os.remove(i)
-            out = os.path.join(output_path, DEM_file_name)
-            os.rename(output_dem_file, out)
+                for i in output_path.glob("*/*"+DEM_file_name):
+                    shutil.rmtree(i.parent.resolve())
+                for i in output_path.glob("*log*.txt"):
+                    i.unlink()
+            out = output_dem_file
             print(out)
             now = datetime.now()
             dt = now - start
@@ -228,6 +265,47 @@ def process_3DEP_laz_to_DEM(
             return out
 
 
+def process_3DEP_laz_to_DEM_batch(
+    list_of_bounds,
+    output_path="./",
+    cache_directory="cache",
+    pdal_threads=4,
+    max_workers=None,
+    **kwargs
+):
+    """
+    Runs process_3DEP_laz_to_DEM for multiple bounds concurrently, one process per
+    bounds. Each run writes to output_path/<index> and the boundary cache is read once.
+    
+    max_workers defaults to cpus / pdal_threads, so PDAL threads don't oversubscribe the cpus.
+    Additional keyword arguments are passed on to process_3DEP_laz_to_DEM.
+    
+    Returns list of output DEM files in the order of list_of_bounds.
+    """
+    boundaries_gdf = hsfm.dataquery.load_3DEP_boundaries(cache_directory=cache_directory)
+    
+    if isinstance(max_workers, type(None)):
+        max_workers = max(1, min(len(list_of_bounds), int(_N_CPU) // pdal_threads))
+    
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = []
+        for i, bounds in enumerate(list_of_bounds):
+            futures.append(
+                executor.submit(
+                    process_3DEP_laz_to_DEM,
+                    bounds,
+                    output_path=os.path.join(output_path, str(i).zfill(3)),
+                    cache_directory=cache_directory,
+                    boundaries_gdf=boundaries_gdf,
+                    pdal_threads=pdal_threads,
+                    **kwargs
+                )
+            )
+        outputs = [future.result() for future in futures]
+    
+    return outputs
+
+
 def divide_bounds_to_tiles(bounds, result_gdf, pad=0.0003, width=0.01, height=0.01):
     xmin, ymin, xmax, ymax = [bounds[2], bounds[1], bounds[0], bounds[3]]
     xmin, ymin, xmax, ymax = xmin - pad, ymin - pad, xmax + pad, ymax + pad
@@ -274,7 +352,7 @@ def grid_3DEP_multi_laz(input_directory, epsg_code, dem_resolution=1, verbose=Fa
         '"point2dem --nodata-value -9999 --t_srs '
         + out_srs
         + " --threads "
-        + str(psutil.cpu_count(logical=True))
+        + _N_CPU
         + " --tr "
         + str(dem_resolution)
         + ' {}"'
@@ -291,7 +369,7 @@ def grid_3DEP_multi_laz(input_directory, epsg_code, dem_resolution=1, verbose=Fa
         "dem_mosaic",
         tmp,
         "--threads",
-        str(psutil.cpu_count(logical=True)),
+        _N_CPU,
         "-o",
         out,
     ]
@@ -308,7 +386,7 @@ def grid_3DEP_laz(laz_file, epsg_code, dem_resolution=1, verbose=False):
         "--nodata-value",
         "-9999",
         "--threads",
-        str(psutil.cpu_count(logical=True)),
+        _N_CPU,
         "--t_srs",
         out_srs,
         "--tr",
@@ -317,18 +395,36 @@ def grid_3DEP_laz(laz_file, epsg_code, dem_resolution=1, verbose=False):
     ]
     hsfm.utils.run_command(call, verbose=verbose)
 
-    file_path = str(pathlib.Path(laz_file).parent.resolve())
-    file_name = str(pathlib.Path(laz_file).stem)
-    output_dem_file = os.path.join(file_path, file_name + "-DEM.tif")
+    laz_file = pathlib.Path(laz_file).resolve()
+    output_dem_file = str(laz_file.with_name(laz_file.stem + "-DEM.tif"))
     return output_dem_file
 
 
 def run_3DEP_pdal_pipeline(pipeline_json_file, verbose=True):
-
-    call = ["pdal", "pipeline", pipeline_json_file]
+    """
+    Executes pipeline in-process with the PDAL python bindings if available,
+    otherwise with the pdal command line application.
+    """
+    try:
+        import pdal
+    except ImportError:
+        pdal = None
+    
+    if pdal is None:
+        call = ["pdal", "pipeline", pipeline_json_file]
+        if verbose:
+            call.extend(["--verbose", "7"])
+        hsfm.utils.run_command(call, verbose=verbose)
+        return None
+    
+    with open(pipeline_json_file) as f:
+        pipeline = pdal.Pipeline(f.read())
     if verbose:
-        call.extend(["--verbose", "7"])
-    hsfm.utils.run_command(call, verbose=verbose)
+        print("pdal pipeline", pipeline_json_file)
+    count = pipeline.execute()
+    if verbose:
+        print("Processed", count, "points.")
+    return pipeline.metadata
 
 
 def create_3DEP_pipeline(
@@ -339,7 +435,15 @@ def create_3DEP_pipeline(
     pipeline_json_file="pipeline.json",
 #     output_laz_file="output.laz",
     output_laz_file="output#.laz", # use this if using filters.splitter
+    output_dem_file=None,
+    dem_resolution=1,
+    threads=None,
 ):
+    """
+    If output_dem_file is specified, points are gridded with writers.gdal in the same
+    pipeline and no intermediate laz file is written. Returns the dem file in place 
+    of the laz file.
+    """
     pipeline_json_file = os.path.join(output_path, pipeline_json_file)
     output_laz_file = os.path.join(output_path, output_laz_file)
 
@@ -347,10 +451,17 @@ def create_3DEP_pipeline(
     filename = os.path.join(base_url, aws_3DEP_directory, "ept.json")
     print("Downloading from", filename)
 
-    lons, lats = bounds_gdf.to_crs("EPSG:3857").geometry.boundary.loc[0].xy
-    lats = sorted(list(set(lats)))
-    lons = sorted(list(set(lons)))
-    bounds_str = "(" + str(lons) + "," + str(lats) + ")"
+    minx, miny, maxx, maxy = bounds_gdf.to_crs("EPSG:3857").total_bounds
+    bounds_str = "([" + str(minx) + "," + str(maxx) + "],[" + str(miny) + "," + str(maxy) + "])"
+
+    # readers.ept works in EPSG:3857, where one unit covers cos(lat) metres on the ground.
+    # scale at the latitude closest to the equator, so the read is never coarser than dem_resolution
+    _, min_lat, _, max_lat = bounds_gdf.to_crs("EPSG:4326").total_bounds
+    if min_lat <= 0 <= max_lat:
+        equatorward_lat = 0
+    else:
+        equatorward_lat = min(abs(min_lat), abs(max_lat))
+    ept_resolution = dem_resolution / np.cos(np.radians(equatorward_lat))
 
     out_srs = "EPSG:" + str(epsg_code)
 
@@ -360,8 +471,11 @@ def create_3DEP_pipeline(
                 "type": "readers.ept",
                 "filename": filename,
                 "bounds": bounds_str,
-                "threads": str(psutil.cpu_count(logical=True)),
+                # only read octree levels needed to grid at dem_resolution
+                "resolution": float(ept_resolution),
+                "threads": int(threads) if threads else int(_N_CPU),
             },
+            # drop returns before reprojecting, so fewer points are transformed
             {"type": "filters.returns", "groups": "first,only"},
             {"type": "filters.reprojection", "in_srs": "EPSG:3857", "out_srs": out_srs},
 #             {"type":"filters.range","limits":"Classification![7:7]"},
@@ -376,70 +490,174 @@ def create_3DEP_pipeline(
             #                             "mean_k":12,
             #                             "multiplier":2.2
             #                         },
-            output_laz_file,
         ]
     }
+    
+    if output_dem_file:
+        output_file = os.path.join(output_path, output_dem_file)
+        pipeline["pipeline"].append(
+            {
+                "type": "writers.gdal",
+                "filename": output_file,
+                "resolution": dem_resolution,
+                "output_type": "idw",
+                "nodata": -9999,
+                "data_type": "float32",
+                "gdalopts": "TILED=YES,COMPRESS=ZSTD,PREDICTOR=3,BIGTIFF=IF_SAFER",
+            }
+        )
+    else:
+        output_file = output_laz_file
+        pipeline["pipeline"].append(output_laz_file)
 
-    with open(pipeline_json_file, "w") as f:
+    # write to a temporary file and swap it in, so readers never see a partial file
+    tmp_file = pipeline_json_file + "." + str(os.getpid()) + ".tmp"
+    with open(tmp_file, "w") as f:
         json.dump(pipeline, f)
+    os.replace(tmp_file, pipeline_json_file)
 
-    return pipeline_json_file, output_laz_file
+    return pipeline_json_file, output_file
 
 
-def get_3DEP_lidar_data_dirs(bounds, cache_directory="cache"):
+def list_3DEP_directories(fs, 
+                          base_url="s3://usgs-lidar-public/", 
+                          cache_directory="cache",
+                          max_age_days=7):
     """
-    bounds = [east, south, west, north]
+    Lists directories in the 3DEP bucket. The listing is cached in cache_directory
+    and reused until it is older than max_age_days.
     """
-    fs = fsspec.filesystem("s3", anon=True)
-
-    base_url = "s3://usgs-lidar-public/"
+    pathlib.Path(cache_directory).mkdir(parents=True, exist_ok=True)
+    out = os.path.join(cache_directory, "aws_3DEP_directories.json")
+    
+    if os.path.isfile(out):
+        age_days = (time.time() - os.path.getmtime(out)) / 86400
+        if age_days < max_age_days:
+            with open(out) as f:
+                return json.load(f)
+    
     aws_3DEP_directories = fs.ls(base_url)
+    with open(out, "w") as f:
+        json.dump(aws_3DEP_directories, f)
+    
+    return aws_3DEP_directories
 
-    vertices = [
-        (bounds[0], bounds[1]),
-        (bounds[0], bounds[3]),
-        (bounds[2], bounds[3]),
-        (bounds[2], bounds[1]),
-    ]
 
-    bounds_polygon = Polygon(vertices)
-    bounds_gdf = gpd.GeoDataFrame(
-        gpd.GeoSeries(bounds_polygon), columns=["geometry"], crs="epsg:4326"
-    )
-    data_dirs_without_boundary_file = []
+def _fetch_3DEP_boundary(fs, directory, boundaries_directory=None):
+    """
+    Returns directory and its boundary.json as GeoDataFrame, or None if not available.
+    
+    If boundaries_directory is specified, each boundary is cached there as 
+    <directory>.geojson and only fetched from S3 if not already cached.
+    """
+    name = directory.split("/")[-1]
+    if not isinstance(boundaries_directory, type(None)):
+        cached_file = os.path.join(boundaries_directory, name + ".geojson")
+        if os.path.isfile(cached_file):
+            with open(cached_file, "rb") as f:
+                return directory, _geojson_to_gdf(f.read(), name)
+    try:
+        dir_url = "s3://" + directory
+        url = os.path.join(dir_url, "boundary.json")
+        buf = fs.cat_file(url)
+    except FileNotFoundError:
+        return directory, None
+    
+    if not isinstance(boundaries_directory, type(None)):
+        with open(cached_file, "wb") as f:
+            f.write(buf)
+    return directory, _geojson_to_gdf(buf, name)
+
+
+def _geojson_to_gdf(buf, directory_name):
+    """
+    Parses a small GeoJSON document directly, without initializing an OGR driver.
+    """
+    obj = json.loads(buf)
+    if obj["type"] == "FeatureCollection":
+        geometries = [shape(feature["geometry"]) for feature in obj["features"]]
+    elif obj["type"] == "Feature":
+        geometries = [shape(obj["geometry"])]
+    else:
+        geometries = [shape(obj)]
+    gdf = gpd.GeoDataFrame({"directory": [directory_name] * len(geometries),
+                            "geometry": geometries}, 
+                           crs="epsg:4326")
+    return gdf
 
+
+def _overlay_3DEP_boundaries(df, bounds_gdf):
+    """
+    Intersects boundaries with bounds, after pre-selecting candidates with the spatial index.
+    """
+    hits = df.sindex.query(bounds_gdf.geometry.iloc[0], predicate="intersects")
+    candidates = df.iloc[np.sort(hits)]
+    return gpd.overlay(candidates, bounds_gdf)
+
+
+def load_3DEP_boundaries(cache_directory="cache"):
+    """
+    Returns GeoDataFrame with the boundary of each 3DEP directory on AWS.
+    Read from cache_directory/boundary.geojson, which is built on first use.
+    """
     pathlib.Path(cache_directory).mkdir(parents=True, exist_ok=True)
     out = os.path.join(cache_directory, "boundary.geojson")
 
     if os.path.isfile(out):
-        df = gpd.read_file(out)
-        result_gdf = gpd.overlay(df, bounds_gdf)
-
-    else:
-        print('Caching boundary.json files in',
-              cache_directory,
-              'directory')
-        df = gpd.GeoDataFrame(columns=["directory", "geometry"])
-        for directory in aws_3DEP_directories:
-            if os.path.isfile(out):
-                gdf = gpd.read_file(out)
-                gdf["directory"] = directory.split("/")[-1]
-                df = df.append(gdf)
+        return gpd.read_file(out)
+    
+    fs = fsspec.filesystem("s3", anon=True)
+    base_url = "s3://usgs-lidar-public/"
+    data_dirs_without_boundary_file = []
+    
+    print('Caching boundary.json files in',
+          cache_directory,
+          'directory')
+    aws_3DEP_directories = list_3DEP_directories(fs, 
+                                                 base_url=base_url, 
+                                                 cache_directory=cache_directory)
+    
+    # boundaries are cached per directory, so only new directories are fetched
+    boundaries_directory = os.path.join(cache_directory, "boundaries")
+    pathlib.Path(boundaries_directory).mkdir(parents=True, exist_ok=True)
+    
+    frames = []
+    
+    # requests are latency bound, so overlap them with threads
+    with concurrent.futures.ThreadPoolExecutor(max_workers=16) as executor:
+        results = executor.map(lambda directory: _fetch_3DEP_boundary(fs, 
+                                                                      directory, 
+                                                                      boundaries_directory),
+                               aws_3DEP_directories)
+        for directory, gdf in results:
+            if isinstance(gdf, type(None)):
+                # not doing anything with this but could log
+                data_dirs_without_boundary_file.append(directory)
             else:
-                try:
-                    dir_url = "s3://" + directory
-                    url = os.path.join(dir_url, "boundary.json")
-                    gdf = gpd.read_file(fs.open(url, "rb"))
-                    gdf["directory"] = directory.split("/")[-1]
-                    df = df.append(gdf)
-                except FileNotFoundError:
-                    # not doing anything with this but could log
-                    data_dirs_without_boundary_file.append(directory)
-                    pass
+                frames.append(gdf)
+
+    df = gpd.GeoDataFrame(pd.concat(frames, ignore_index=True), crs="epsg:4326")
+    df.to_file(out, driver="GeoJSON")
+    return df
+
 
-        df.crs = bounds_gdf.crs
-        df.to_file(out, driver="GeoJSON")
-        result_gdf = gpd.overlay(df, bounds_gdf)
+def get_3DEP_lidar_data_dirs(bounds, cache_directory="cache", boundaries_gdf=None):
+    """
+    bounds = [east, south, west, north]
+    
+    boundaries_gdf: output of load_3DEP_boundaries(), to avoid re-reading the cache.
+    """
+    bounds_polygon = box(
+        min(bounds[0], bounds[2]),
+        min(bounds[1], bounds[3]),
+        max(bounds[0], bounds[2]),
+        max(bounds[1], bounds[3]),
+    )
+    bounds_gdf = gpd.GeoDataFrame({"geometry": [bounds_polygon]}, crs="epsg:4326")
+    
+    if isinstance(boundaries_gdf, type(None)):
+        boundaries_gdf = load_3DEP_boundaries(cache_directory=cache_directory)
+    result_gdf = _overlay_3DEP_boundaries(boundaries_gdf, bounds_gdf)
 
     return result_gdf, bounds_gdf
 
@@ -448,17 +666,38 @@ def get_UTM_EPSG_code_from_bounds(bounds):
     """
     bounds = [east, south, west, north]
     """
-    east_south_epsg_code = hsfm.geospatial.lon_lat_to_utm_epsg_code(
-        bounds[0], bounds[1]
-    )
-    west_north_epsg_code = hsfm.geospatial.lon_lat_to_utm_epsg_code(
-        bounds[2], bounds[3]
-    )
-
-    if east_south_epsg_code == west_north_epsg_code:
-        epsg_code = west_north_epsg_code
+    # single lookup of all WGS 84 UTM zones intersecting the bounds,
+    # available from pyproj 3.0
+    try:
+        from pyproj.aoi import AreaOfInterest
+        from pyproj.database import query_utm_crs_info
+        
+        utm_crs_info = query_utm_crs_info(
+            datum_name="WGS 84",
+            area_of_interest=AreaOfInterest(
+                west_lon_degree=min(bounds[0], bounds[2]),
+                south_lat_degree=min(bounds[1], bounds[3]),
+                east_lon_degree=max(bounds[0], bounds[2]),
+                north_lat_degree=max(bounds[1], bounds[3]),
+            ),
+        )
+        epsg_codes = sorted(set(i.code for i in utm_crs_info if i.auth_name == "EPSG"))
+    except ImportError:
+        epsg_codes = []
+    
+    if len(epsg_codes) == 1:
+        epsg_code = epsg_codes[0]
         return epsg_code
     else:
+        east_south_epsg_code = hsfm.geospatial.lon_lat_to_utm_epsg_code(
+            bounds[0], bounds[1]
+        )
+        west_north_epsg_code = hsfm.geospatial.lon_lat_to_utm_epsg_code(
+            bounds[2], bounds[3]
+        )
+        if east_south_epsg_code == west_north_epsg_code:
+            epsg_code = west_north_epsg_code
+            return epsg_code
         print("Bounds span two UTM zones.")
         print(
             "EPSG:" + west_north_epsg_code,
@@ -470,58 +709,71 @@ def get_UTM_EPSG_code_from_bounds(bounds):
         return epsg_code
 
 
+def _representative_coords(gdf):
+    """
+    Returns (x, y) of a representative point for each geometry, computed in one vectorized call.
+    """
+    points = gdf.geometry.representative_point()
+    return list(zip(points.x, points.y))
+
+
 def plot_3DEP_bounds(
-    result_gdf, bounds_gdf, tile_polygons_gdf=None, qc_plot_output_directory=None
+    result_gdf, 
+    bounds_gdf, 
+    tile_polygons_gdf=None, 
+    qc_plot_output_directory=None,
+    with_basemap=False,
+    cache_directory="cache",
 ):
     """
     takes outputs from tools.get_3DEP_lidar_data_dirs()
 
     results_gdf: geopandas.geodataframe.GeoDataFrame
     bounds_gdf: geopandas.geodataframe.GeoDataFrame
+    
+    with_basemap: fetch satellite basemap tiles. Tiles are cached in 
+                  cache_directory/basemap_tiles and reused on later runs.
 
     """
 
-    bounds_gdf["coords"] = bounds_gdf["geometry"].apply(
-        lambda x: x.representative_point().coords[:]
-    )
-    result_gdf["coords"] = result_gdf["geometry"].apply(
-        lambda x: x.representative_point().coords[:]
-    )
+    bounds_gdf["coords"] = _representative_coords(bounds_gdf)
+    result_gdf["coords"] = _representative_coords(result_gdf)
 
     prop_cycle = plt.rcParams["axes.prop_cycle"]
     colors = prop_cycle.by_key()["color"]
 
     fig, ax = plt.subplots(figsize=(10, 10))
 
-    for i, v in enumerate(result_gdf.index):
-        result_gdf.loc[result_gdf.index == i].plot(
-            ax=ax, edgecolor=colors[i], facecolor="none", linewidth=3
-        )
+    # one collection for all boundaries, colored per row
+    edgecolors = [colors[i % len(colors)] for i in range(len(result_gdf.index))]
+    result_gdf.plot(ax=ax, edgecolor=edgecolors, facecolor="none", linewidth=3)
 
     if not isinstance(tile_polygons_gdf, type(None)):
-        tile_polygons_gdf["coords"] = tile_polygons_gdf["geometry"].apply(
-            lambda x: x.representative_point().coords[:]
-        )
+        tile_polygons_gdf["coords"] = _representative_coords(tile_polygons_gdf)
         tile_polygons_gdf.plot(ax=ax, edgecolor=(0,0,0,1), facecolor=(0,0,1,0.1))
         for idx, row in tile_polygons_gdf.iterrows():
-            plt.annotate(s=str(idx), xy=row["coords"][0], horizontalalignment="center")
+            plt.annotate(s=str(idx), xy=row["coords"], horizontalalignment="center")
 
     bounds_gdf.plot(ax=ax, edgecolor="black", facecolor="none", linewidth=1)
 
-    try:
-        ctx.add_basemap(
-            ax,
-            source="https://mt1.google.com/vt/lyrs=s&x={x}&y={y}&z={z}",
-            crs=bounds_gdf.crs.to_string(),
-            alpha=0.5,
-        )
-    except:
-        # if fails the bounds are likely too small to pull a tile
-        pass
+    if with_basemap:
+        tile_cache_directory = os.path.join(cache_directory, "basemap_tiles")
+        pathlib.Path(tile_cache_directory).mkdir(parents=True, exist_ok=True)
+        ctx.set_cache_dir(tile_cache_directory)
+        try:
+            ctx.add_basemap(
+                ax,
+                source="https://mt1.google.com/vt/lyrs=s&x={x}&y={y}&z={z}",
+                crs=bounds_gdf.crs.to_string(),
+                alpha=0.5,
+            )
+        except:
+            # if fails the bounds are likely too small to pull a tile
+            pass
 
     for idx, row in result_gdf.iterrows():
         plt.annotate(
-            s=row["directory"], xy=row["coords"][0], horizontalalignment="center"
+            s=row["directory"], xy=row["coords"], horizontalalignment="center"
         )
 
     if qc_plot_output_directory:
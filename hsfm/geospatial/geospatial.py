@@ -1,18 +1,11 @@
-import cartopy.crs as ccrs
-import contextily as ctx
 import geopandas as gpd
-import geoviews as gv
-from geoviews import opts
 import haversine
-import holoviews as hv
-from holoviews.streams import PointDraw
 import math
 import numpy as np
 import os
 from osgeo import gdal
 import pyproj
 import pandas as pd
-import panel as pn
 import requests
 import urllib
 import rasterio
@@ -108,29 +101,24 @@ def extract_gpd_geometry(point_gdf):
         point_gdf['z'] = z
     return point_gdf
         
+def _utm_zone(lon):
+    return (math.floor((lon + 180) / 6) % 60) + 1
+
 def lon_lat_to_utm_epsg_code(lon, lat):
     """
     Function to retrieve local UTM EPSG code from WGS84 geographic coordinates.
     """
-    utm_band = str((math.floor((lon + 180) / 6 ) % 60) + 1)
-    if len(utm_band) == 1:
-        utm_band = '0'+utm_band
     if lat >= 0:
-        epsg_code = '326' + utm_band
+        return '326%02d' % _utm_zone(lon)
     else:
-        epsg_code = '327' + utm_band
-    return epsg_code
+        return '327%02d' % _utm_zone(lon)
     
 def lon_lat_to_utm_navd88_epsg_code(lon, lat):
     """
     Function to retrieve local UTM EPSG code from WGS84 geographic coordinates using NAVD88 as vertical datum.
     """
-    utm_band = str((math.floor((lon + 180) / 6 ) % 60) + 1)
-    if len(utm_band) == 1:
-        utm_band = '0'+ utm_band
     if lat >= 0:
-        epsg_code = '269' + utm_band
-        return epsg_code
+        return '269%02d' % _utm_zone(lon)
     else:
         print('Not sure what the right NAD83 / UTM zone EPSG code is for southern latitudes.')
 
@@ -204,12 +192,15 @@ def rescale_geotif_to_file(geotif_file_name, scale_factor):
 def request_basemap_tiles(lon, lat, dx, dy, 
                           url='https://mt1.google.com/vt/lyrs=s&x={X}&y={Y}&z={Z}',
                           utm=False):
-                            
+    
+    # interactive mapping libraries are imported on first use, see hsfm.utils.load_holoviews
+    hsfm.utils.load_holoviews()
+    import cartopy.crs as ccrs
+    import geoviews as gv
+    
     if utm == False:
         extents = (lon-dx, lat-dy, lon+dx, lat+dy)
         tiles = gv.WMTS(url, extents=extents)
-        location = gv.Points([], vdims="vertices")                   
-        point_stream = PointDraw(source=location)
         tiles = gv.WMTS(url, extents=extents)
         
         return tiles
@@ -230,6 +221,13 @@ def request_basemap_tiles(lon, lat, dx, dy,
     
 def pick_points_from_basemap_tiles(tiles, utm_zone=None):
     
+    hsfm.utils.load_holoviews()
+    import cartopy.crs as ccrs
+    import geoviews as gv
+    from geoviews import opts
+    from holoviews.streams import PointDraw
+    import panel as pn
+    
     if utm_zone == None:
         location = gv.Points([], vdims="vertices")
     
@@ -248,13 +246,17 @@ def pick_points_from_basemap_tiles(tiles, utm_zone=None):
     
 def basemap_points_to_dataframe(point_stream):
     
+    import geoviews as gv
+    
     df = gv.operation.project_points(point_stream.element).dframe()
     return df
     
 def download_basemap_tiles_as_geotif(lon, lat, dx, dy,
                                      output_file_name='output.tif',
                                      url="https://mt1.google.com/vt/lyrs=s&x={x}&y={y}&z={z}"):
-                                     
+    
+    import contextily as ctx
+    
     west, south, east, north = (lon-dx, lat-dy, lon+dx, lat+dy)
     
     img = ctx.tile.bounds2raster(west,
@@ -339,8 +341,13 @@ def reproject_geotif(geotif_file_name,
         output_file_name = os.path.join(file_path,file_name+'_EPSG_'+str(epsg_code)+file_extension)
         
     call = ['gdalwarp',
+            '--config','GDAL_CACHEMAX','512',
+            '-multi',
+            '-wo','NUM_THREADS=ALL_CPUS',
+            '-wm','512',
             '-co','COMPRESS=LZW',
             '-co','TILED=YES',
+            '-co','NUM_THREADS=ALL_CPUS',
             '-co','BIGTIFF=IF_SAFER',
             '-dstnodata', '-9999',
             '-r','cubic',
@@ -354,41 +361,47 @@ def reproject_geotif(geotif_file_name,
     
 def get_epsg_code(dem_file_name):
     
-    src = rasterio.open(dem_file_name)
-    epsg_code = str(src.crs.to_epsg())
+    epsg_code = hsfm.io.load_dem_header(dem_file_name)['epsg_code']
     
     return epsg_code
 
+def get_dem_box(dem_file_name):
+    """
+    Returns shapely box of DEM bounds. Read once per file from the cached DEM header.
+    """
+    return hsfm.io.load_dem_header(dem_file_name)['box']
+
 def sample_dem(lons, lats, dem_file_name):
     # TODO
     # - check fill value from DEM
     # - interpolate value if fill value or nan
     
-    src = rasterio.open(dem_file_name)
-    epsg_code = get_epsg_code(dem_file_name)
-    
-    data = {'lon': lons, 'lat': lats}
-    df = pd.DataFrame(data)
-    gdf = hsfm.geospatial.df_xy_coords_to_gdf(df)
-    gdf = hsfm.geospatial.extract_gpd_geometry(gdf)
-    gdf = gdf.to_crs('epsg:'+epsg_code)
+    # the DEM stays open across calls, as this is called per image,
+    # and only the blocks under the sampled points are read
+    header = hsfm.io.load_dem_header(dem_file_name)
+    src = hsfm.io.open_dem(dem_file_name)
     
-    lons = gdf.x.to_list()
-    lats = gdf.y.to_list()
-    lon_lats = list(zip(lons, lats))
+    transformer = pyproj.Transformer.from_crs('epsg:4326', 
+                                              'epsg:'+header['epsg_code'], 
+                                              always_xy=True)
+    x, y = transformer.transform(np.atleast_1d(np.asarray(lons, dtype=float)), 
+                                 np.atleast_1d(np.asarray(lats, dtype=float)))
     
-    elevations = []
-    for elevation in src.sample(lon_lats):
-        elevations.append(elevation[0])
+    elevations = [elevation[0] for elevation in src.sample(zip(x, y), indexes=1)]
     return elevations
 
 # From https://github.com/dshean/pygeotools/blob/master/pygeotools/lib/geolib.py
 # Formulas for CE90/LE90 here:
 # http://www.fgdc.gov/standards/projects/FGDC-standards-projects/accuracy/part3/chapter3
 
+def _RMSE(offset):
+    # plain ndarray reduction, avoids pandas overhead when given a Series
+    offset = np.asarray(offset, dtype=float).ravel()
+    return np.sqrt(np.dot(offset, offset)/offset.size)
+
 def CE90(x_offset,y_offset):
-    RMSE_x = np.sqrt(np.sum(x_offset**2)/x_offset.size) 
-    RMSE_y = np.sqrt(np.sum(y_offset**2)/y_offset.size) 
+    RMSE_x = _RMSE(x_offset)
+    RMSE_y = _RMSE(y_offset)
     c95 = 2.4477
     c90 = 2.146
     RMSE_min = min(RMSE_x, RMSE_y)
@@ -401,7 +414,7 @@ def CE90(x_offset,y_offset):
     return out
 
 def LE90(z_offset):
-    RMSE_z = np.sqrt(np.sum(z_offset**2)/z_offset.size)
+    RMSE_z = _RMSE(z_offset)
     c95 = 1.9600
     c90 = 1.6449
     return c90 * RMSE_z
@@ -413,13 +426,8 @@ def compare_dem_extent(dem1_file,
     Returns larger_dem_extent_file, smaller_dem_extent_file
     '''
     
-    ds = rasterio.open(dem1_file)
-    bounds = ds.bounds
-    a = bounds.right - bounds.left + bounds.top - bounds.bottom
-
-    ds = rasterio.open(dem2_file)
-    bounds = ds.bounds
-    b = bounds.right - bounds.left + bounds.top - bounds.bottom
+    a = get_dem_box(dem1_file).length
+    b = get_dem_box(dem2_file).length
     
     if a > b:
         return dem1_file, dem2_file
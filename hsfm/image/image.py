@@ -2,6 +2,7 @@ import PIL
 import os
 import cv2
 import numpy as np
+from osgeo import gdal
 from skimage import exposure
 
 import hsfm.io
@@ -29,6 +30,34 @@ def img_linear_stretch_full(img_gray):
     img_rescale = exposure.rescale_intensity(img_gray, in_range=(p_min, p_max))
     return img_rescale
 
+def read_image_gray(image_file_name, overview=None):
+    """
+    Reads an image as a single band uint8 array with GDAL.
+    Only the first band is decoded for single band scans. RGB inputs are
+    converted with BT.601 weights. Specify overview to read a downsampled
+    overview level instead of full resolution, if available.
+    """
+    ds = gdal.Open(image_file_name, gdal.GA_ReadOnly)
+
+    if ds.RasterCount >= 3:
+        bands = []
+        for i in range(1,4):
+            band = ds.GetRasterBand(i)
+            if overview is not None and band.GetOverviewCount() > overview:
+                band = band.GetOverview(overview)
+            bands.append(band.ReadAsArray())
+        arr = np.stack(bands, axis=-1)
+        img_gray = np.dot(arr, [0.299, 0.587, 0.114]).astype(np.uint8)
+
+    else:
+        band = ds.GetRasterBand(1)
+        if overview is not None and band.GetOverviewCount() > overview:
+            band = band.GetOverview(overview)
+        img_gray = band.ReadAsArray()
+
+    ds = None
+    return img_gray
+
 '''
 ####
 FUNCTIONS BELOW HERE ARE NOT ACTIVELY USED, BUT KEPT FOR NOW.
@@ -1 +1,2 @@
-from .io import *
\ No newline at end of file
+from .io import *
+from .dem_cache import *
\ No newline at end of file
@@ -0,0 +1,66 @@
+"""
+Cached access to DEMs that are read repeatedly during a processing run.
+"""
+
+import collections
+import functools
+import os
+import rasterio
+from shapely.geometry import box
+
+# open datasets by absolute file name, as (mtime, dataset), least recently used first
+_OPEN_DEMS     = collections.OrderedDict()
+_MAX_OPEN_DEMS = 4
+
+def load_dem_header(dem_file_name):
+    """
+    Returns dictionary with epsg_code, bounds, box, transform, nodata, width and height of DEM.
+    Cached per file and invalidated when the file is modified.
+    """
+    dem_file_name = os.path.abspath(dem_file_name)
+    return _load_dem_header(dem_file_name, os.path.getmtime(dem_file_name))
+
+def open_dem(dem_file_name):
+    """
+    Returns open rasterio dataset of DEM for windowed reads and sampling.
+    The dataset is kept open and reused while the file is unchanged. Handles of modified
+    or least recently used DEMs are closed.
+    """
+    dem_file_name = os.path.abspath(dem_file_name)
+    mtime = os.path.getmtime(dem_file_name)
+    
+    if dem_file_name in _OPEN_DEMS:
+        cached_mtime, src = _OPEN_DEMS.pop(dem_file_name)
+        if cached_mtime == mtime and not src.closed:
+            _OPEN_DEMS[dem_file_name] = (cached_mtime, src)
+            return src
+        src.close()
+    
+    while len(_OPEN_DEMS) >= _MAX_OPEN_DEMS:
+        _, (_, src) = _OPEN_DEMS.popitem(last=False)
+        src.close()
+    
+    src = rasterio.open(dem_file_name)
+    _OPEN_DEMS[dem_file_name] = (mtime, src)
+    return src
+
+def close_dems():
+    """
+    Closes all DEM datasets kept open by open_dem.
+    """
+    while _OPEN_DEMS:
+        _, (_, src) = _OPEN_DEMS.popitem()
+        src.close()
+
+@functools.lru_cache(maxsize=16)
+def _load_dem_header(dem_file_name, mtime):
+    with rasterio.open(dem_file_name) as src:
+        epsg_code = src.crs.to_epsg()
+        header = {'epsg_code': str(epsg_code),
+                  'bounds'   : src.bounds,
+                  'box'      : box(*src.bounds),
+                  'transform': src.transform,
+                  'nodata'   : src.nodata,
+                  'width'    : src.width,
+                  'height'   : src.height}
+    return header
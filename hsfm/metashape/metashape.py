@@ -19,12 +19,100 @@ Agisoft Metashape processing pipeline.
 ### SETUP
 # TODO handle import Metashape with class structure
 
+# licence symlinks already set up by this process
+_authenticated = set()
+
 def authentication(METASHAPE_LICENCE_FILE):
+    """
+    Symlinks the Metashape licence file into the working directory.
+    Repeated calls for the same licence and directory return without touching the filesystem.
+    """
     metashape_licence_file_symlink = os.path.join(os.getcwd(),
                                                   os.path.basename(METASHAPE_LICENCE_FILE))
+    if metashape_licence_file_symlink in _authenticated:
+        return
     if not os.path.exists(metashape_licence_file_symlink):
-        os.symlink(METASHAPE_LICENCE_FILE,
-                   metashape_licence_file_symlink)
+        try:
+            os.symlink(METASHAPE_LICENCE_FILE,
+                       metashape_licence_file_symlink)
+        except FileExistsError:
+            # created by a concurrent batch worker in the meantime
+            pass
+    _authenticated.add(metashape_licence_file_symlink)
+
+def check_metashape():
+    """
+    Exits with an error if the Metashape python library can not be imported or is not activated.
+    Call before long running processing so it fails before any work is done.
+    """
+    try:
+        import Metashape
+    except:
+        print('\nCould not import Metashape python library. Check your licence and installation.\n')
+        sys.exit(1)
+    if not Metashape.app.activated:
+        print('\nMetashape is not activated. Check your licence.\n')
+        sys.exit(1)
+
+def _import_metashape():
+    try:
+        import Metashape
+    except:
+        print('\nCould not import Metashape python library. Check your licence and installation.\n')
+        sys.exit(1)
+    return Metashape
+
+def _setup_project(project_name, output_path, overwrite):
+    """
+    Creates output_path and returns the project, report and point cloud file names in it.
+    """
+    if overwrite:
+        shutil.rmtree(output_path, ignore_errors=True)
+        os.makedirs(output_path)
+    else:
+        try:
+            os.makedirs(output_path)
+        except:
+            print('\nDirectory exists:',output_path, '\nPlease remove or rename it.\n')
+            sys.exit(0) 
+    
+    metashape_project_file = os.path.join(output_path, project_name  + ".psx")
+    report_file            = os.path.join(output_path, project_name  + "_report.pdf")
+    point_cloud_file       = os.path.join(output_path, project_name  + ".las")
+    return metashape_project_file, report_file, point_cloud_file
+
+def _import_reference(chunk, images_metadata_file, crs, rotation_enabled):
+    import Metashape
+    
+    chunk.importReference(images_metadata_file,
+                          columns="nxyzXYZabcABC", # from metashape py api docs
+                          delimiter=',',
+                          format=Metashape.ReferenceFormatCSV)
+
+    chunk.crs = Metashape.CoordinateSystem(crs)
+    chunk.updateTransform()
+    
+    for i,v in enumerate(chunk.cameras):
+        v.reference.rotation_enabled = rotation_enabled
+
+def _build_dense_cloud_and_export(doc,
+                                  chunk,
+                                  densecloud_quality,
+                                  report_file,
+                                  point_cloud_file,
+                                  export_point_cloud):
+    import Metashape
+    
+    chunk.buildDepthMaps(downscale=densecloud_quality,
+                         filter_mode=Metashape.AggressiveFiltering)
+    chunk.buildDenseCloud()
+    doc.save()
+    
+    chunk.exportReport(report_file)
+    if export_point_cloud:
+        chunk.exportPoints(path=point_cloud_file,
+                           format=Metashape.PointsFormatLAS, 
+                           crs=chunk.crs)
 
 
 def images2las(project_name,
@@ -49,33 +137,17 @@ def images2las(project_name,
     densecloud_quality      = Ultra/High/Medium/Low/Lowest   -> 1/2/4/8/16
     """
 
-    try:
-        import Metashape
-    except:
-        print('\nCould not import Metashape python library. Check your licence and installation.\n')
-        sys.exit(0)
+    Metashape = _import_metashape()
     
     # PROJECT SETUP
     
-    if overwrite:
-        shutil.rmtree(output_path) 
-        os.makedirs(output_path)
-    else:
-        try:
-            os.makedirs(output_path)
-        except:
-            print('\nDirectory exists:',output_path, '\nPlease remove or rename it.\n')
-            sys.exit(0) 
-    
-    metashape_project_file = os.path.join(output_path, project_name  + ".psx")
-    report_file            = os.path.join(output_path, project_name  + "_report.pdf")
-    point_cloud_file       = os.path.join(output_path, project_name  + ".las")
+    metashape_project_file, report_file, point_cloud_file = _setup_project(project_name,
+                                                                           output_path,
+                                                                           overwrite)
 
     doc = Metashape.Document()
     doc.save(metashape_project_file)
 
-    crs = Metashape.CoordinateSystem(crs)
-
     chunk = doc.chunk
     if len(doc.chunks):
         chunk = doc.chunk
@@ -99,23 +171,13 @@ def images2las(project_name,
     chunk.addPhotos(image_files_subset)
 
     # DEFINE EXTRINSICS
-    chunk.importReference(images_metadata_file,
-                          columns="nxyzXYZabcABC", # from metashape py api docs
-                          delimiter=',',
-                          format=Metashape.ReferenceFormatCSV)
-
-    chunk.crs = crs
-    chunk.updateTransform()
-    
-    for i,v in enumerate(chunk.cameras):
-        v.reference.rotation_enabled = rotation_enabled
+    _import_reference(chunk, images_metadata_file, crs, rotation_enabled)
         
     # DEFINE INTRINSICS
     if isinstance(camera_model_xml_file, type(None)) and isinstance(focal_length, type(None)):
         # try to grab a focal length for every camera from metadata in case run on mix of cameras
         try:
-            df_tmp        = pd.read_csv(images_metadata_file)
-            focal_lengths = df_tmp['focal_length'].values
+            focal_lengths = metashape_metadata_df['focal_length'].values
             print('Assigning focal length for each camera specified in metadata csv file.')
             for i,v in enumerate(chunk.cameras):
                     v.sensor.focal_length = focal_lengths[i]
@@ -133,8 +195,7 @@ def images2las(project_name,
     if isinstance(camera_model_xml_file, type(None)) and isinstance(pixel_pitch, type(None)):
         # try to grab a pixel pitch for every camera from metadata in case run on mix of cameras
         try:
-            df_tmp        = pd.read_csv(images_metadata_file)
-            pixel_pitches = df_tmp['pixel_pitch'].values
+            pixel_pitches = metashape_metadata_df['pixel_pitch'].values
             print('Assigning pixel pitch for each camera specified in metadata csv file.')
             for i,v in enumerate(chunk.cameras):
                 print('Camera',i,pixel_pitches[i])
@@ -237,20 +298,71 @@ def images2las(project_name,
 
 #     doc.save()
     
-    # BUILD DENSE CLOUD
+    # BUILD DENSE CLOUD AND EXPORT
+    
+    _build_dense_cloud_and_export(doc,
+                                  chunk,
+                                  densecloud_quality,
+                                  report_file,
+                                  point_cloud_file,
+                                  export_point_cloud)
 
-    chunk.buildDepthMaps(downscale=densecloud_quality,
-                         filter_mode=Metashape.AggressiveFiltering)
-    chunk.buildDenseCloud()
+    return metashape_project_file, point_cloud_file
+
+def realign_images2las(previous_metashape_project_file,
+                       project_name,
+                       images_metadata_file,
+                       output_path,
+                       crs                     = 'EPSG::4326',
+                       densecloud_quality      = 2,
+                       rotation_enabled        = True,
+                       export_point_cloud      = True,
+                       overwrite               = False):
+    """
+    Same as images2las, but starts from a copy of an earlier project for the same images.
+    The tie points and camera alignment of that project are kept and refined with
+    optimizeCameras against the positions in images_metadata_file, which skips the
+    costly photo matching and alignment.
+    Cameras not listed in images_metadata_file are removed.
+    """
+
+    Metashape = _import_metashape()
+    
+    # PROJECT SETUP
+    
+    metashape_project_file, report_file, point_cloud_file = _setup_project(project_name,
+                                                                           output_path,
+                                                                           overwrite)
+
+    # saving to the new path leaves the earlier project untouched
+    doc = Metashape.Document()
+    doc.open(previous_metashape_project_file)
+    doc.save(metashape_project_file)
+    doc.read_only = False
+    
+    chunk = doc.chunk
+
+    metashape_metadata_df = pd.read_csv(images_metadata_file)
+    image_base_names = set(os.path.splitext(i)[0] for i in metashape_metadata_df['image_file_name'].values)
+    chunk.remove([cam for cam in chunk.cameras if cam.label not in image_base_names])
+
+    # DEFINE EXTRINSICS
+    _import_reference(chunk, images_metadata_file, crs, rotation_enabled)
+    
+    # BUNDLE ADJUSTMENT
+    
+    # refine the existing alignment against the updated camera positions
+    chunk.optimizeCameras()
     doc.save()
     
-    # EXPORT
+    # BUILD DENSE CLOUD AND EXPORT
     
-    chunk.exportReport(report_file)
-    if export_point_cloud:
-        chunk.exportPoints(path=point_cloud_file,
-                           format=Metashape.PointsFormatLAS, 
-                           crs=chunk.crs)
+    _build_dense_cloud_and_export(doc,
+                                  chunk,
+                                  densecloud_quality,
+                                  report_file,
+                                  point_cloud_file,
+                                  export_point_cloud)
 
     return metashape_project_file, point_cloud_file
 
@@ -263,7 +375,7 @@ def oc32dem(project_name,
     import Metashape
 
     doc = Metashape.Document()
-    doc.open(output_path + project_name + ".psx")
+    doc.open(os.path.join(output_path, project_name + ".psx"))
     doc.read_only = False
 
     chunk = doc.chunk
@@ -294,7 +406,7 @@ def images2ortho(project_name,
     ortho_file = os.path.join(output_path, project_name  +"_orthomosaic.tif")
 
     doc = Metashape.Document()
-    doc.open(output_path + project_name + ".psx")
+    doc.open(os.path.join(output_path, project_name + ".psx"))
     doc.read_only = False
 
     chunk = doc.chunk
@@ -429,10 +541,13 @@ def update_ba_camera_metadata(metashape_project_file,
                               image_file_extension = '.tif'):
     '''
     Returns dataframe with bundle adjusted camera positions and camera positions for cameras
-    that were not able to be aligned.
+    that were not able to be aligned. metashape_metadata_csv can be a csv file or DataFrame.
     '''
     
-    metashape_metadata_df = pd.read_csv(metashape_metadata_csv)
+    if isinstance(metashape_metadata_csv, type(pd.DataFrame())):
+        metashape_metadata_df = metashape_metadata_csv
+    else:
+        metashape_metadata_df = pd.read_csv(metashape_metadata_csv)
     
     metashape_export = hsfm.metashape.get_estimated_camera_centers(metashape_project_file)
     images, lons, lats, alts, yaws, pitches, rolls, omegas, phis, kappas = metashape_export
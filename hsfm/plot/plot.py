@@ -292,6 +292,8 @@ def plot_offsets(LE90,
     plt.subplots_adjust(top=0.85)
     if not isinstance(plot_file_name, type(None)):
         plt.savefig(plot_file_name, bbox_inches='tight', pad_inches=0,dpi=300)
+        # close so figures do not accumulate over batch iterations
+        plt.close(fig)
     
     else:
         plt.show()
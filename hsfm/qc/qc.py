@@ -3,6 +3,7 @@ import os
 import numpy as np
 import pandas as pd
 from osgeo import gdal
+import rasterio
 import shutil
 from datetime import datetime
 
@@ -57,9 +58,9 @@ def match_files_to_combined_df(match_files_list):
 def calc_matchpoint_coverage(match_files_list,image_directory):
     
     image_files_list=sorted(glob.glob(os.path.join(image_directory,'*.tif')))
-    img_ds = gdal.Open(image_files_list[0])
-    dim_x = img_ds.RasterXSize
-    dim_y = img_ds.RasterYSize
+    with rasterio.open(image_files_list[0]) as src:
+        dim_x = src.width
+        dim_y = src.height
     
     df_combined, keys = match_files_to_combined_df(match_files_list)
     
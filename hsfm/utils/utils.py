@@ -1,32 +1,20 @@
-import hvplot
-import hvplot.xarray
-import hvplot.pandas
 import rasterio
 import xarray as xr
-import cartopy.crs as ccrs
-import geoviews as gv
-from geoviews import opts
+import functools
 import glob
-import holoviews as hv
 from osgeo import gdal
 import os
 import pandas as pd
-import panel as pn
 import numpy as np
-import PIL
 import shutil
 import subprocess
-from subprocess import Popen, PIPE, STDOUT
-import time
-import utm
+from subprocess import Popen, PIPE, STDOUT, DEVNULL
+import threading
+import concurrent.futures
 import cv2
-import py3dep
 from pathlib import Path
-from holoviews.streams import BoxEdit
 import psutil
-
-
-hv.extension('bokeh')
+import re
 
 import hsfm.io
 import hsfm.geospatial
@@ -35,6 +23,26 @@ import hsfm.geospatial
 """
 Utilities that call other software as subprocesses.
 """
+
+# The plotting stack is only needed by the interactive tools,
+# so it is imported on first use rather than with the module.
+@functools.lru_cache(maxsize=None)
+def load_holoviews():
+    """
+    Imports holoviews and hvplot and activates the bokeh extension once. Returns holoviews.
+    """
+    import holoviews as hv
+    import hvplot.xarray
+    import hvplot.pandas
+    hv.extension('bokeh')
+    return hv
+
+@functools.lru_cache(maxsize=None)
+def _plate_carree_crs():
+    # built once and shared by the interactive pickers
+    import cartopy.crs as ccrs
+    return ccrs.PlateCarree()
+
 def replace_and_fill_nodata_value(array, nodata_value, fill_value):
     """
     Replace nodata values with fill value in array.
@@ -120,6 +128,11 @@ def bbox_selector(metadata_csv = None,
     Draw bounding box (hold shift) on basemap and return vertices.
     Select bounding box to delete.
     '''
+    load_holoviews()
+    import geoviews as gv
+    from geoviews import opts
+    from holoviews.streams import BoxEdit
+    
     OpenTopoMap       = 'https://tile.opentopomap.org/{Z}/{X}/{Y}.png'
     OpenStreetMap     = 'http://tile.openstreetmap.org/{Z}/{X}/{Y}.png'
     GoogleHybrid      = 'https://mt1.google.com/vt/lyrs=y&x={X}&y={Y}&z={Z}'
@@ -176,13 +189,72 @@ def dem_align_custom(reference_dem,
         path, file_name, _    = hsfm.io.split_file(dem_to_be_aligned)
         dem_align_output_path = os.path.join(path,file_name+'_dem_align')
         log_file              = run_command(call, verbose=verbose, log_directory=dem_align_output_path)
-        try:
-            dem_difference_file   = glob.glob(os.path.join(dem_align_output_path,'*_align_diff.tif'))[0]
-            aligned_dem_file      = glob.glob(os.path.join(dem_align_output_path,'*_align.tif'))[0]
-
+        dem_difference_file, aligned_dem_file = _parse_dem_align_log(log_file)
+        if not (dem_difference_file and aligned_dem_file):
+            dem_difference_file, aligned_dem_file = _find_dem_align_outputs(dem_align_output_path)
+        if dem_difference_file and aligned_dem_file:
             return dem_difference_file , aligned_dem_file
-        except:
+        else:
             print('Unable to align dem using dem_align.py. See', log_file, 'for additional details.')
+
+def dem_align_custom_many(dem_file_name_pairs,
+                          max_workers=None,
+                          **kwargs):
+    """
+    Runs dem_align_custom for many (reference_dem, dem_to_be_aligned) pairs concurrently.
+    Each dem_align.py run is single threaded, so running them side by side uses the other cpus.
+    Additional keyword arguments are passed on to dem_align_custom.
+    
+    Returns list of dem_align_custom results in the order of dem_file_name_pairs.
+    """
+    if isinstance(max_workers, type(None)):
+        max_workers = os.cpu_count()
+    
+    def _align(pair):
+        return dem_align_custom(*pair, **kwargs)
+    
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(_align, dem_file_name_pairs))
+
+_DEM_ALIGN_OUTPUT_RE = re.compile(r'(\S+?_align(_diff)?\.tif)\b')
+
+def _parse_dem_align_log(log_file):
+    # output file names as reported by dem_align.py, kept only if they exist
+    dem_difference_file = None
+    aligned_dem_file    = None
+    if not log_file or not os.path.isfile(log_file):
+        return dem_difference_file, aligned_dem_file
+    with open(log_file, errors='replace') as f:
+        for line in f:
+            for match in _DEM_ALIGN_OUTPUT_RE.finditer(line):
+                file_name = match.group(1).strip('\'"')
+                if match.group(2):
+                    dem_difference_file = file_name
+                else:
+                    aligned_dem_file = file_name
+    if dem_difference_file and not os.path.isfile(dem_difference_file):
+        dem_difference_file = None
+    if aligned_dem_file and not os.path.isfile(aligned_dem_file):
+        aligned_dem_file = None
+    return dem_difference_file, aligned_dem_file
+
+def _find_dem_align_outputs(dem_align_output_path):
+    # single directory pass that stops as soon as both outputs are found
+    dem_difference_file = None
+    aligned_dem_file    = None
+    if not os.path.isdir(dem_align_output_path):
+        return dem_difference_file, aligned_dem_file
+    with os.scandir(dem_align_output_path) as entries:
+        for entry in entries:
+            if not entry.is_file():
+                continue
+            if dem_difference_file is None and entry.name.endswith('_align_diff.tif'):
+                dem_difference_file = entry.path
+            elif aligned_dem_file is None and entry.name.endswith('_align.tif'):
+                aligned_dem_file = entry.path
+            if dem_difference_file and aligned_dem_file:
+                break
+    return dem_difference_file, aligned_dem_file
             
 def mask_dem(dem,
              output_directory = None,
@@ -193,16 +265,40 @@ def mask_dem(dem,
     if output_directory == None:
         output_directory = path
     
-    call = ['dem_mask.py', '--outdir']
-    call.extend([output_directory])
-    call.extend(masks)
-    call.extend([dem])
+    call = ['dem_mask.py', '--outdir', output_directory, *masks, dem]
     
     hsfm.utils.run_command(call,verbose=verbose)
     
     return os.path.join(output_directory, base+'_ref.tif')
     
 
+@functools.lru_cache(maxsize=None)
+def gtiff_compression_options():
+    """
+    Returns GTiff compression creation options, used for DEM and image outputs.
+    ZSTD with horizontal differencing when libtiff was built with it, DEFLATE otherwise.
+    """
+    creation_options = gdal.GetDriverByName('GTiff').GetMetadataItem('DMD_CREATIONOPTIONLIST') or ''
+    if 'ZSTD' in creation_options:
+        return ('COMPRESS=ZSTD', 'PREDICTOR=2', 'ZSTD_LEVEL=1')
+    else:
+        return ('COMPRESS=DEFLATE', 'PREDICTOR=2')
+
+@functools.lru_cache(maxsize=None)
+def cog_creation_options():
+    """
+    Returns COG creation options, limited to what the installed driver supports.
+    """
+    creation_options = gdal.GetDriverByName('COG').GetMetadataItem('DMD_CREATIONOPTIONLIST') or ''
+    options = ['BIGTIFF=IF_SAFER', 'NUM_THREADS=ALL_CPUS', 'RESAMPLING=AVERAGE']
+    if 'ZSTD' in creation_options:
+        options.append('COMPRESS=ZSTD')
+    else:
+        options.append('COMPRESS=DEFLATE')
+    if 'PREDICTOR' in creation_options:
+        options.append('PREDICTOR=YES')
+    return tuple(options)
+
 def rescale_geotif(geotif_file_name,
                    output_directory=None,
                    output_file_name=None,
@@ -228,11 +324,14 @@ def rescale_geotif(geotif_file_name,
         output_file_name = os.path.join(file_path, 
                                         file_name+'_sub'+str(scale)+file_extension)
     
+    compression = [arg for option in gtiff_compression_options() for arg in ('-co', option)]
+    
     call = ['gdal_translate',
             '-of','GTiff',
             '-co','TILED=YES',
-            '-co','COMPRESS=LZW',
+            *compression,
             '-co','BIGTIFF=IF_SAFER',
+            '-co','NUM_THREADS=ALL_CPUS',
             '-outsize',percent,percent,
             geotif_file_name,
             output_file_name]
@@ -256,13 +355,60 @@ def optimize_geotif(geotif_file_name,
             '-co','TILED=YES',
             '-co','COMPRESS=LZW',
             '-co','BIGTIFF=IF_SAFER',
+            '-co','NUM_THREADS=ALL_CPUS',
             geotif_file_name,
             output_file_name]
     run_command(call, verbose=verbose)
-    
+
+    return output_file_name
+
+def write_geotif(grayscale_unit8_image_array,
+                 output_file_name,
+                 overview_levels=(2,4,8,16,32)):
+    """
+    Writes a single band uint8 array to a tiled, compressed GeoTIFF with
+    internal overviews in one pass. Replaces cv2.imwrite followed by optimize_geotif.
+    """
+    img = grayscale_unit8_image_array
+
+    creation_options = ['TILED=YES',
+                        'BLOCKXSIZE=512',
+                        'BLOCKYSIZE=512',
+                        *gtiff_compression_options(),
+                        'NUM_THREADS=ALL_CPUS',
+                        'BIGTIFF=IF_SAFER',
+                        'SPARSE_OK=TRUE']
+
+    driver = gdal.GetDriverByName('GTiff')
+    ds = driver.Create(output_file_name,
+                       img.shape[1],
+                       img.shape[0],
+                       1,
+                       gdal.GDT_Byte,
+                       options=creation_options)
+    band = ds.GetRasterBand(1)
+    band.WriteArray(img)
+    band = None
+    if overview_levels:
+        ds.BuildOverviews('AVERAGE', list(overview_levels))
+    ds = None
+
     return output_file_name
 
 
+def _tiles_intersecting_bounds(tile_file_names, bounds):
+    """
+    bounds = (ULLON, ULLAT, LRLON, LRLAT)
+    """
+    ullon, ullat, lrlon, lrlat = bounds
+    tiles = []
+    for tile_file_name in tile_file_names:
+        with rasterio.open(tile_file_name) as src:
+            left, bottom, right, top = src.bounds
+        if left < lrlon and right > ullon and bottom < ullat and top > lrlat:
+            tiles.append(tile_file_name)
+    return tiles
+
 def download_srtm(bounds,
                   output_directory='./input_data/reference_dem/',
                   utm=False,
@@ -292,19 +438,25 @@ def download_srtm(bounds,
                    max_download_tiles=999)
 
     tifs = glob.glob(os.path.join(output_directory,'SRTM3/cache/','*tif'))
+    # the cache can hold tiles from earlier downloads, only index the ones needed
+    tifs = _tiles_intersecting_bounds(tifs, bounds)
+    if not tifs:
+        raise ValueError('No SRTM tiles in '+os.path.join(output_directory,'SRTM3/cache/')+
+                         ' intersect bounds '+str(bounds)+'. Bounds should be (ULLON, ULLAT, LRLON, LRLAT).')
     
     vrt_file_name = os.path.join(output_directory,'SRTM3/cache/srtm.vrt')
     
-    call = ['gdalbuildvrt', vrt_file_name]
-    call.extend(tifs)
-    run_command(call, verbose=verbose)
-
+    # build the mosaic in-process rather than launching gdalbuildvrt
+    ds = gdal.BuildVRT(vrt_file_name, tifs, resolution='highest')
     
-    ds = gdal.Open(vrt_file_name)
+    # the subset is a virtual raster, so no pixels are read or written until dem_geoid
     vrt_subset_file_name = os.path.join(output_directory,'SRTM3/cache/srtm_subset.vrt')
     ds = gdal.Translate(vrt_subset_file_name,
                         ds, 
+                        format  = 'VRT',
                         projWin = [bounds[0], bounds[1], bounds[2], bounds[3]])
+    # close to flush the vrt to disk before it is read by dem_geoid
+    ds = None
                         
     
     # Adjust from EGM96 geoid to WGS84 ellipsoid
@@ -324,10 +476,30 @@ def download_srtm(bounds,
     
         # Convert to UTM
         utm_vrt_subset_file_name = os.path.join(output_directory,'SRTM3/cache/srtm_subset_utm_geoid_adj.tif')
-        call = 'gdalwarp -co COMPRESS=LZW -co TILED=YES -co BIGTIFF=IF_SAFER -dstnodata -9999 -r cubic -t_srs EPSG:' + epsg_code
-        call = call.split()
-        call.extend([adjusted_vrt_subset_file_name,utm_vrt_subset_file_name])
-        run_command(call, verbose=verbose)
+        # warp and compress with all cpus
+        warp_options = dict(dstSRS          = 'EPSG:' + epsg_code,
+                            resampleAlg     = 'cubic',
+                            dstNodata       = -9999,
+                            multithread     = True,
+                            warpMemoryLimit = 512,
+                            warpOptions     = ['NUM_THREADS=ALL_CPUS', 'SKIP_NOSOURCE=YES'])
+        if gdal.GetDriverByName('COG') is not None:
+            # write a cloud optimized geotiff, so later reads can use windows and overviews
+            ds = gdal.Warp('', adjusted_vrt_subset_file_name, format='VRT', **warp_options)
+            ds = gdal.Translate(utm_vrt_subset_file_name,
+                                ds,
+                                format          = 'COG',
+                                creationOptions = list(cog_creation_options()))
+        else:
+            ds = gdal.Warp(utm_vrt_subset_file_name,
+                           adjusted_vrt_subset_file_name,
+                           creationOptions = list(gtiff_compression_options()) + \
+                                             ['TILED=YES', 'NUM_THREADS=ALL_CPUS', 'BIGTIFF=IF_SAFER'],
+                           **warp_options)
+        if ds is None:
+            print('Unable to warp', adjusted_vrt_subset_file_name, 'to EPSG:' + epsg_code)
+        # close to flush the warped dem to disk
+        ds = None
         
         if cleanup == True:
             out = os.path.join(output_directory,os.path.split(utm_vrt_subset_file_name)[-1])
@@ -355,6 +527,8 @@ def download_3DEP_DTM(bounds,
     '''
     bounds = (west_lon, south_lat, east_lon, north_lat)
     '''
+    # imported here as py3dep is slow to import and only needed for this download
+    import py3dep
     
     if not threads:
         #use all cores
@@ -431,14 +605,11 @@ def clip_reference_dem(dem_file,
     """
     # TODO check that input DEMs are both in utm
     
-    rasterio_dataset = rasterio.open(dem_file)
-    bounds = rasterio_dataset.bounds
+    bounds = hsfm.io.load_dem_header(dem_file)['bounds']
     left   = str(bounds[0] - buff_size)
     top    = str(bounds[3] + buff_size)
     right  = str(bounds[2] + buff_size)
     bottom = str(bounds[1] - buff_size)
-    center = str(rasterio_dataset.xy(rasterio_dataset.height // 2, 
-                                     rasterio_dataset.width // 2))
     
     call =['gdal_translate',
           '-projwin',
@@ -486,26 +657,48 @@ def difference_dems(dem_file_name_a,
 
 
 
+def difference_dems_many(dem_file_name_pairs,
+                         max_workers=None,
+                         verbose=False):
+    """
+    Runs difference_dems for many (dem_file_name_a, dem_file_name_b) pairs concurrently.
+    Threads are used as the work happens in geodiff subprocesses.
+    
+    Returns list of output difference files in the order of dem_file_name_pairs.
+    """
+    if isinstance(max_workers, type(None)):
+        max_workers = os.cpu_count()
+    
+    def _difference(pair):
+        return difference_dems(*pair, verbose=verbose)
+    
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(_difference, dem_file_name_pairs))
+
+
 ## TODO move to hsfm.core as best fit (for now)
-def pick_headings(image_directory, camera_positions_file_name, subset, delta=0.015):
-    df = hsfm.core.select_images_for_download(camera_positions_file_name, subset)
-    
-    image_file_paths = sorted(glob.glob(os.path.join(image_directory, '*.tif')))
-    lons = df['Longitude'].values
-    lats = df['Latitude'].values
-
-    headings = []
-    for i, v in enumerate(lats):
-        image_file_name = image_file_paths[i]
-        camera_center_lon = lons[i]
-        camera_center_lat = lats[i]
-
-        heading = pick_heading_from_map(image_file_name,
-                                        camera_center_lon,
-                                        camera_center_lat,
-                                        dx= delta,
-                                        dy= delta)
-        headings.append(heading)
+def pick_headings(image_files, df, delta=0.015):
+    """
+    Launches pick_heading_from_map for each image and returns df with a heading column.
+    image_files is a list of image files, or a directory of tifs, in the same order as the rows of df.
+    """
+    if isinstance(image_files, type('')):
+        image_files = sorted(glob.glob(os.path.join(image_files, '*.tif')))
+    if len(image_files) != len(df):
+        raise ValueError('Mismatch between metadata entries in camera position file and available images: '+
+                         str(len(image_files))+' images vs '+str(len(df))+' metadata rows.')
+    
+    lons = df['Longitude'].to_numpy()
+    lats = df['Latitude'].to_numpy()
+
+    headings = [None]*len(lats)
+    for i, (image_file_name, camera_center_lon, camera_center_lat) in \
+        enumerate(zip(image_files, lons, lats)):
+        headings[i] = pick_heading_from_map(image_file_name,
+                                            camera_center_lon,
+                                            camera_center_lat,
+                                            dx= delta,
+                                            dy= delta)
 
     df['heading'] = headings
 
@@ -513,10 +706,29 @@ def pick_headings(image_directory, camera_positions_file_name, subset, delta=0.0
 
 ## TODO move to hsfm.trig (might need to rename library as hsfm.math)
 def scale_down_number(number, threshold=1000):
-    while number > threshold:
-        number = number / 2
+    """
+    Halves number until it is at or below threshold and returns it as int.
+    """
     number = int(number)
-    return number
+    if number <= threshold:
+        return number
+    # fewest halvings k with number / 2**k <= threshold, applied as one bit shift
+    shift = ((number - 1) // int(threshold)).bit_length()
+    return number >> shift
+
+def _wait_for_points(point_stream, n_points):
+    """
+    Blocks until point_stream holds n_points drawn points.
+    """
+    done = threading.Event()
+    
+    def _check(data=None, **kwargs):
+        if data is not None and len(data.get('x', [])) >= n_points:
+            done.set()
+    
+    point_stream.add_subscriber(_check)
+    _check(point_stream.data)
+    done.wait()
 
 ## TODO move to hsfm.tools (needs to be created) as this launches a self contained app
 def pick_camera_location(image_file_path, 
@@ -525,13 +737,17 @@ def pick_camera_location(image_file_path,
                          dx = 0.030,
                          dy = 0.030):
     
+    hv = load_holoviews()
+    import geoviews as gv
+    from geoviews import opts
+    import panel as pn
+    
     # Google Satellite tiled basemap imagery url
     url = 'https://mt1.google.com/vt/lyrs=s&x={X}&y={Y}&z={Z}'
 
-    # TODO
-    # # allow large images to be plotted or force resampling to thumbnail
-    # # load the image with xarray and plot with hvplot to handle larger images
-    img, subplot_width, subplot_height = hsfm.utils.hv_plot_raster(image_file_path)
+    # the image is only a visual reference here, so a static regrid is enough
+    img, subplot_width, subplot_height = hsfm.utils.hv_plot_raster(image_file_path,
+                                                                   rasterize=False)
 
     # create the extent of the bounding box
     extents = (center_lon-dx, 
@@ -560,17 +776,11 @@ def pick_camera_location(image_file_path,
 
     server = row.show(threaded=True)
 
-    condition = True
-    while condition == True:
-        try:
-            if len(point_stream.data['x']) == 2:
-                server.stop()
-                condition = False
-        except:
-            pass
+    _wait_for_points(point_stream, 2)
+    server.stop()
 
     projected = gv.operation.project_points(point_stream.element,
-                                            projection=ccrs.PlateCarree())
+                                            projection=_plate_carree_crs())
     
     image_file_basename = os.path.splitext(os.path.basename(image_file_path))[0]
     
@@ -589,14 +799,15 @@ def pick_heading_from_map(image_file_name,
                           dx = 0.015,
                           dy = 0.015):
                           
+    hv = load_holoviews()
+    import geoviews as gv
+    from geoviews import opts
+    import panel as pn
 
     # Google Satellite tiled basemap imagery url
     url = 'https://mt1.google.com/vt/lyrs=s&x={X}&y={Y}&z={Z}'
     
-    # TODO
-    # # allow large images to be plotted or force resampling to thumbnail
-    # # load the image with xarray and plot with hvplot to handle larger images
-    img, subplot_width, subplot_height = hv_plot_raster(image_file_name)
+    img, subplot_width, subplot_height = hv_plot_raster_thumbnail(image_file_name)
 
     # create the extent of the bounding box
     extents = (camera_center_lon-dx, 
@@ -625,17 +836,11 @@ def pick_heading_from_map(image_file_name,
 
     server = row.show(threaded=True)
 
-    condition = True
-    while condition == True:
-        try:
-            if len(point_stream.data['x']) == 2:
-                server.stop()
-                condition = False
-        except:
-            pass
+    _wait_for_points(point_stream, 2)
+    server.stop()
 
     projected = gv.operation.project_points(point_stream.element,
-                                            projection=ccrs.PlateCarree())
+                                            projection=_plate_carree_crs())
     df = projected.dframe()
     df['location'] = ['camera_center', 'flight_direction']
     
@@ -656,6 +861,8 @@ def create_fiducials(image_array,
     """
     Select inner most point to crop from, in order left - top - right - bottom.
     """
+    hv = load_holoviews()
+    import panel as pn
                      
     hsfm.io.create_dir(output_directory)
                      
@@ -681,14 +888,8 @@ def create_fiducials(image_array,
 
     server = panel.show(threaded=True)
 
-    condition = True
-    while condition == True: 
-        try:
-            if len(point_stream.data['x']) == 4:
-                server.stop()
-                condition = False
-        except:
-            pass
+    _wait_for_points(point_stream, 4)
+    server.stop()
 
     df = point_stream.element.dframe()
 
@@ -736,6 +937,9 @@ def create_fiducials(image_array,
 
 ## TODO move to hsfm.tools (needs to be created) as this launches a self contained app
 def launch_fiducial_picker(hv_image, subplot_width, subplot_height):
+    hv = load_holoviews()
+    import panel as pn
+    
     points = hv.Points([])
     point_stream = hv.streams.PointDraw(source=points)
 
@@ -749,14 +953,8 @@ def launch_fiducial_picker(hv_image, subplot_width, subplot_height):
 
     server = panel.show(threaded=True)
 
-    condition = True
-    while condition == True: 
-        try:
-            if len(point_stream.data['x']) == 4:
-                server.stop()
-                condition = False
-        except:
-            pass
+    _wait_for_points(point_stream, 4)
+    server.stop()
     
     df = point_stream.element.dframe()
     
@@ -776,26 +974,74 @@ def launch_fiducial_picker(hv_image, subplot_width, subplot_height):
 
 ## TODO move to hsfm.core as best fit (for now)
 def hv_plot_raster(image_file_name,
-                   stretch_histogram = False):
-    src = rasterio.open(image_file_name)
-
-    subplot_width  = scale_down_number(src.shape[0])
-    subplot_height = scale_down_number(src.shape[1])
+                   stretch_histogram = False,
+                   rasterize = True):
+    """
+    Plots band 1 of image_file_name.
+    With rasterize=False the image is regridded once with datashader and shown as a
+    static image, instead of being re-rasterized on every pan and zoom.
+    """
+    hv = load_holoviews()
+    
+    # open lazily in chunks, so only what is rasterized for display is read
+    try:
+        import rioxarray
+        da = rioxarray.open_rasterio(image_file_name, chunks={'x': 1024, 'y': 1024})
+    except ImportError:
+        da = xr.open_rasterio(image_file_name, chunks={'x': 1024, 'y': 1024})
 
-    da = xr.open_rasterio(src)
+    subplot_width  = scale_down_number(da.shape[1])
+    subplot_height = scale_down_number(da.shape[2])
     
     if stretch_histogram:
         da.values = hsfm.image.img_linear_stretch_full(da.values)
 
-    hv_image = da.sel(band=1).hvplot.image(rasterize=True,
-                                      width=subplot_width,
+    if rasterize:
+        hv_image = da.sel(band=1).hvplot.image(rasterize=True,
+                                          width=subplot_width,
+                                          height=subplot_height,
+                                          flip_yaxis=True,
+                                          colorbar=False,
+                                          cmap='gray')
+    else:
+        import datashader
+        canvas = datashader.Canvas(plot_width=subplot_width, plot_height=subplot_height)
+        agg = canvas.raster(da.sel(band=1))
+        hv_image = hv.Image(agg).opts(width=subplot_width,
                                       height=subplot_height,
-                                      flip_yaxis=True,
+                                      invert_yaxis=True,
                                       colorbar=False,
                                       cmap='gray')
                                       
     return hv_image, subplot_width, subplot_height
 
+def hv_plot_raster_thumbnail(image_file_name):
+    """
+    Plots a decimated read of band 1 sized to the display, using overviews when present.
+    """
+    load_holoviews()
+    
+    with rasterio.open(image_file_name) as src:
+        subplot_width  = scale_down_number(src.width)
+        subplot_height = scale_down_number(src.height)
+        arr = src.read(1,
+                       out_shape=(subplot_height, subplot_width),
+                       resampling=rasterio.enums.Resampling.average)
+        width, height = src.width, src.height
+    
+    # keep coordinates in full resolution pixel space
+    x = (np.arange(subplot_width) + 0.5) * width / subplot_width
+    y = (np.arange(subplot_height) + 0.5) * height / subplot_height
+    da = xr.DataArray(arr, coords={'y': y, 'x': x}, dims=('y', 'x'))
+    
+    hv_image = da.hvplot.image(width=subplot_width,
+                               height=subplot_height,
+                               flip_yaxis=True,
+                               colorbar=False,
+                               cmap='gray')
+    
+    return hv_image, subplot_width, subplot_height
+
 ## TODO move to hsfm.core as best fit (for now)
 def pick_fiducials(image_file_name):
     
@@ -815,29 +1061,50 @@ def run_command(command, verbose=False, log_directory=None, shell=False):
     else:
         print(*command)
     
-    p = Popen(command,
-              stdout=PIPE,
-              stderr=STDOUT,
-              shell=shell)
+    # output that is neither logged nor printed is discarded by the os,
+    # so there is no pipe to read and we only wait for the process to exit
+    if log_directory == None and verbose != True:
+        p = Popen(command,
+                  stdout=DEVNULL,
+                  stderr=STDOUT,
+                  shell=shell)
+        p.wait()
+        return
     
     if log_directory != None:
         log_file_name = os.path.join(log_directory,command[0]+'_log.txt')
         hsfm.io.create_dir(log_directory)
-    
-        with open(log_file_name, "w") as log_file:
-            
-            while p.poll() is None:
-                line = (p.stdout.readline()).decode('ASCII').rstrip('\n')
-                if verbose == True:
-                    print(line)
-                log_file.write(line)
+        
+        # log the raw bytes through a large buffer and only decode what is printed
+        p = Popen(command,
+                  stdout=PIPE,
+                  stderr=STDOUT,
+                  shell=shell)
+        
+        with p.stdout, open(log_file_name, 'wb', buffering=65536) as log_file:
+            if verbose == True:
+                for line in p.stdout:
+                    print(line.decode(errors='replace').rstrip('\n'))
+                    log_file.write(line)
+            else:
+                shutil.copyfileobj(p.stdout, log_file, 65536)
+        p.wait()
         return log_file_name
     
     else:
-        while p.poll() is None:
-            line = (p.stdout.readline()).decode('ASCII').rstrip('\n')
-            if verbose == True:
-                print(line)
+        # stream output line by line so memory stays bounded on long, verbose runs
+        p = Popen(command,
+                  stdout=PIPE,
+                  stderr=STDOUT,
+                  shell=shell,
+                  universal_newlines=True,
+                  errors='replace',
+                  bufsize=1)
+        
+        with p.stdout:
+            for line in p.stdout:
+                print(line.rstrip('\n'))
+        p.wait()
                 
 def run_command2(command, verbose=False, log=False):
     if isinstance(command, type(str())):
@@ -848,8 +1115,18 @@ def run_command2(command, verbose=False, log=False):
     
     log_directory='logs'
     
+    if log == False and verbose != True:
+        p = Popen(command,
+                  stdout=DEVNULL,
+                  stderr=STDOUT,
+                  shell=True)
+        p.wait()
+        return
+    
     p = Popen(command,
               universal_newlines=True,
+              errors='replace',
+              bufsize=1,
               stdout=PIPE,
               stderr=STDOUT,
               shell=True)
@@ -858,17 +1135,16 @@ def run_command2(command, verbose=False, log=False):
         log_file_name = os.path.join(log_directory,command.split(' ')[0]+'_log.txt')
         hsfm.io.create_dir(log_directory)
     
-        with open(log_file_name, "w") as log_file:
-            
-            while p.poll() is None:
-                line = (p.stdout.readline())
+        with p.stdout, open(log_file_name, "w") as log_file:
+            for line in p.stdout:
                 if verbose == True:
-                    print(line)
+                    print(line.rstrip('\n'))
                 log_file.write(line)
+        p.wait()
         return log_file_name
     
     else:
-        while p.poll() is None:
-            if verbose == True:
-                line = (p.stdout.readline())
-                print(line)
\ No newline at end of file
+        with p.stdout:
+            for line in p.stdout:
+                print(line.rstrip('\n'))
+        p.wait()